@@ -0,0 +1,227 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+import torch
+import bundle
+import text_network
+import utils
+import vision_network
+
+
+def time_steps(step_func, device, nb_steps=10, nb_warmup=2):
+    """
+    run step_func a few times and measure it
+    :param step_func: one training or inference step
+    :param device:
+    :param nb_steps:
+    :param nb_warmup: steps run before measuring
+    :return: ms per step, peak memory in MB (0 on cpu)
+    """
+    for _ in range(nb_warmup):
+        step_func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.time()
+    for _ in range(nb_steps):
+        step_func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    ms = (time.time() - start) * 1000 / nb_steps
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else 0.0
+    return ms, peak
+
+
+def random_text(batch_size, seq_len, device):
+    cap = torch.randint(1000, 30000, (batch_size, seq_len), dtype=torch.long, device=device)
+    mask = torch.ones(batch_size, seq_len, dtype=torch.long, device=device)
+    return cap, mask
+
+
+def bench_checkpoint(args, device):
+    """
+    forward and backward of each tower with every activation checkpointing setting
+    """
+    img = torch.randn(args.batchsize, 3, 224, 224, device=device)
+    cap, mask = random_text(args.batchsize, args.seq_len, device)
+    vision_net = vision_network.VisionNet(device)
+    text_net = text_network.TextNet(device)
+    vision_net.model.train()
+    text_net.model.train()
+
+    def vision_step():
+        vision_net.forward(img).sum().backward()
+        vision_net.model.zero_grad()
+
+    def text_step():
+        text_net.forward(cap, mask).sum().backward()
+        text_net.model.zero_grad()
+
+    print("%-8s %-10s %12s %12s" % ("tower", "segments", "ms/step", "peak MB"))
+    for name, net, step_func in [("vision", vision_net, vision_step), ("text", text_net, text_step)]:
+        for segments in [0, 1, 2, 6]:
+            net.model.checkpoint = segments
+            ms, peak = time_steps(step_func, device, args.steps)
+            print("%-8s %-10d %12.1f %12.1f" % (name, segments, ms, peak))
+        net.model.checkpoint = 0
+
+
+def bench_packing(args, device):
+    """
+    the lstm of the text tower over padded captions of random lengths, run over the padding,
+    packed, and packed from a batch sorted by length
+    """
+    lstm = torch.nn.LSTM(768, 768).to(device)
+    hidden_state = torch.randn(args.seq_len, args.batchsize, 768, device=device)
+    lengths = torch.randint(args.seq_len // 4, args.seq_len + 1, (args.batchsize,))
+    sorted_lengths = lengths.sort(descending=True)[0]
+
+    def padded_step():
+        lstm(hidden_state)[1][0][-1].sum().backward()
+
+    def packed_step():
+        packed = torch.nn.utils.rnn.pack_padded_sequence(hidden_state, lengths, enforce_sorted=False)
+        lstm(packed)[1][0][-1].sum().backward()
+
+    def sorted_step():
+        packed = torch.nn.utils.rnn.pack_padded_sequence(hidden_state, sorted_lengths, enforce_sorted=True)
+        lstm(packed)[1][0][-1].sum().backward()
+
+    print("mean caption length %.1f of %d" % (lengths.float().mean().item(), args.seq_len))
+    print("%-10s %12s" % ("lstm", "ms/step"))
+    for name, step_func in [("padded", padded_step), ("packed", packed_step), ("sorted", sorted_step)]:
+        ms, _ = time_steps(step_func, device, args.steps)
+        print("%-10s %12.1f" % (name, ms))
+
+
+def val_accuracy(nets, val_data, device, batch_size):
+    """
+    image to text retrieval accuracy of trained networks
+    :param nets: vision_net, teacher_net1, text_net, teacher_net2 as returned by bundle.load_bundle
+    :param val_data: images, captions and masks of the validation pairs
+    :param device:
+    :param batch_size:
+    :return: accuracy at top 1, accuracy at top 64
+    """
+    vision_net, teacher_net1, text_net, teacher_net2 = nets
+    img_vecs = []
+    txt_vecs = []
+    with torch.no_grad():
+        for start in range(0, val_data[0].size(0), batch_size):
+            img, cap, mask = [t[start: start + batch_size].to(device) for t in val_data]
+            img_vecs.append(teacher_net1.forward(vision_net.forward(img)))
+            txt_vecs.append(teacher_net2.forward(text_net.forward(cap, mask)))
+    nb, correct, correctn = utils.retrieval_accuracy(torch.cat(img_vecs), torch.cat(txt_vecs))
+    return correct / nb, correctn / nb
+
+
+def bench_text(args, device):
+    """
+    caption query latency (one caption) and throughput (a batch) of every text tower variant. With
+    --bundles the variants are the trained ones of the bundles and the table also gives their
+    retrieval accuracy on the first --val_size validation pairs, untrained variants have none
+    """
+    query = random_text(1, args.seq_len, device)
+    batch = random_text(args.batchsize, args.seq_len, device)
+    if args.bundles:
+        variants = args.bundles.split(",")
+        val_data = [utils.load_cached(name)[:args.val_size] for name in ["val_img", "val_cap", "val_mask"]]
+    else:
+        variants = [(pooling, nb_layers) for pooling in text_network.POOLINGS for nb_layers in [6, 3, 1]]
+    print("%-8s %-8s %14s %14s %8s %8s" % ("pooling", "layers", "query ms", "captions/s", "acc@1", "acc@64"))
+    for variant in variants:
+        if args.bundles:
+            nets = bundle.load_bundle(variant, device)
+            for net in [nets[0].model, nets[1], nets[2].model, nets[3]]:
+                net.eval()
+            text_net = nets[2]
+            pooling, nb_layers = text_net.model.pooling, text_net.model.config.n_layers
+            accuracy = "%8.3f %8.3f" % val_accuracy(nets, val_data, device, args.batchsize)
+        else:
+            pooling, nb_layers = variant
+            text_net = text_network.TextNet(device, pooling=pooling, nb_layers=nb_layers)
+            text_net.model.eval()
+            accuracy = "%8s %8s" % ("-", "-")
+        with torch.no_grad():
+            query_ms, _ = time_steps(lambda: text_net.forward(*query), device, args.steps)
+            batch_ms, _ = time_steps(lambda: text_net.forward(*batch), device, args.steps)
+        print("%-8s %-8d %14.2f %14.1f %s" % (pooling, nb_layers, query_ms, args.batchsize * 1000 / batch_ms,
+                                              accuracy))
+        del text_net
+
+
+def bench_vision(args, device):
+    """
+    image indexing throughput of every vision backbone on cpu, with the width of its feature
+    """
+    device = torch.device("cpu")
+    img = torch.randn(args.batchsize, 3, 224, 224)
+    print("%d cpu threads" % torch.get_num_threads())
+    print("%-20s %10s %12s %12s" % ("backbone", "features", "ms/batch", "images/s"))
+    for backbone in vision_network.BACKBONES:
+        try:
+            vision_net = vision_network.VisionNet(device, backbone=backbone)
+        except AssertionError as e:
+            print("%-20s skipped: %s" % (backbone, e))
+            continue
+        vision_net.model.eval()
+        with torch.no_grad():
+            ms, _ = time_steps(lambda: vision_net.forward(img), device, args.steps)
+        print("%-20s %10d %12.1f %12.1f" % (backbone, vision_net.out_features, ms, args.batchsize * 1000 / ms))
+        del vision_net
+
+
+IMPORT_MODULES = ["torch", "utils", "teacher_network", "text_network", "vision_network", "serving", "bundle",
+                  "session_cache"]
+HEAVY_MODULES = ["transformers", "torchvision", "PIL", "knockknock"]
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import %s
+print(json.dumps([time.time() - start, [name for name in %r if name in sys.modules]]))
+"""
+
+
+def bench_imports(args, device):
+    """
+    import time of the modules in a fresh interpreter each, and which heavy dependencies they pull in
+    """
+    print("%-18s %10s  %s" % ("module", "ms", "heavy modules loaded"))
+    for module in IMPORT_MODULES:
+        times = []
+        for _ in range(args.steps):
+            out = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT % (module, HEAVY_MODULES)],
+                                 stdout=subprocess.PIPE, check=True).stdout
+            seconds, loaded = json.loads(out.decode().strip().splitlines()[-1])
+            times.append(seconds)
+        print("%-18s %10.1f  %s" % (module, min(times) * 1000, ", ".join(loaded) or "-"))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument("--what", help="which benchmark to run", default="checkpoint",
+                        choices=["checkpoint", "packing", "text", "vision", "imports"])
+    PARSER.add_argument("--device", help="device to benchmark on", default="cuda:0")
+    PARSER.add_argument("--batchsize", help="batch size", default=32, type=int)
+    PARSER.add_argument("--seq_len", help="caption length in tokens", default=20, type=int)
+    PARSER.add_argument("--steps", help="measured steps per setting", default=10, type=int)
+    PARSER.add_argument("--bundles", help="text: comma separated bundles of trained variants to time and evaluate "
+                                          "instead of the untrained ones", default="", type=str)
+    PARSER.add_argument("--val_size", help="text: validation pairs the accuracy of the bundles is computed on",
+                        default=1000, type=int)
+    MY_ARGS = PARSER.parse_args()
+
+    DEVICE = torch.device(MY_ARGS.device if torch.cuda.is_available() else "cpu")
+    print("benchmarking %s on %s with batch size %d" % (MY_ARGS.what, DEVICE, MY_ARGS.batchsize))
+    if MY_ARGS.what == "checkpoint":
+        bench_checkpoint(MY_ARGS, DEVICE)
+    elif MY_ARGS.what == "packing":
+        bench_packing(MY_ARGS, DEVICE)
+    elif MY_ARGS.what == "text":
+        bench_text(MY_ARGS, DEVICE)
+    elif MY_ARGS.what == "vision":
+        bench_vision(MY_ARGS, DEVICE)
+    elif MY_ARGS.what == "imports":
+        bench_imports(MY_ARGS, DEVICE)
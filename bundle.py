@@ -0,0 +1,117 @@
+import argparse
+import time
+import torch
+import serving
+import teacher_network
+import text_network
+import vision_network
+
+BUNDLE_VERSION = 1
+
+
+def save_bundle(path, vision_net, text_net, teacher_net1, teacher_net2):
+    """
+    save the two towers, their heads, the config to rebuild them and the tokenizer vocab in one file
+    :param path:
+    :param vision_net: VisionNet
+    :param text_net: TextNet
+    :param teacher_net1: TeacherNet3query
+    :param teacher_net2: TeacherNet3key
+    :return:
+    """
+    vocab = text_net.tokenizer.vocab
+    torch.save({
+        "version": BUNDLE_VERSION,
+        "config": {
+            "backbone": vision_net.backbone,
+            "text_pooling": text_net.model.pooling,
+            "distilbert": text_net.model.config.to_dict(),
+        },
+        "vocab": sorted(vocab, key=vocab.get),
+        "special_tokens": serving.added_special_tokens(text_net.tokenizer),
+        "vision": vision_net.model.state_dict(),
+        "text": text_net.model.state_dict(),
+        "query_head": teacher_net1.state_dict(),
+        "key_head": teacher_net2.state_dict(),
+    }, path)
+
+
+def read_bundle(path):
+    """
+    memory map the bundle, tensors are only read from disk when they are used
+    :param path:
+    :return: dict of the bundle
+    """
+    try:
+        bundle = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1 has no mmap loading
+        bundle = torch.load(path, map_location="cpu")
+    assert bundle["version"] == BUNDLE_VERSION, "bundle version %d, expected %d" % (bundle["version"],
+                                                                                    BUNDLE_VERSION)
+    return bundle
+
+
+def load_bundle(path, device="cpu", towers=("image", "text")):
+    """
+    build the networks from the bundle config without any pretrained weights and load them, offline
+    :param path:
+    :param device:
+    :param towers: which towers to build, e.g. only "image" to index photos
+    :return: vision_net, teacher_net1, text_net, teacher_net2 (None for the towers not built)
+    """
+    bundle = read_bundle(path)
+    config = bundle["config"]
+    vision_net, teacher_net1, text_net, teacher_net2 = None, None, None, None
+    if "image" in towers:
+        vision_net = vision_network.VisionNet("cpu", backbone=config["backbone"], pretrained=False)
+        teacher_net1 = teacher_network.TeacherNet3query(vision_net.out_features)
+        load_state(vision_net.model, bundle["vision"], device)
+        load_state(teacher_net1, bundle["query_head"], device)
+    if "text" in towers:
+        # bundles written before special_tokens was saved get a tokenizer which adds none
+        tokenizer = serving.WordPieceTokenizer(tokens=bundle["vocab"], special_tokens=bundle.get("special_tokens"))
+        text_net = text_network.TextNet("cpu", pooling=config["text_pooling"], config=config["distilbert"],
+                                        tokenizer=tokenizer)
+        teacher_net2 = teacher_network.TeacherNet3key()
+        load_state(text_net.model, bundle["text"], device)
+        load_state(teacher_net2, bundle["key_head"], device)
+    return vision_net, teacher_net1, text_net, teacher_net2
+
+
+def load_state(module, state_dict, device):
+    """
+    the module takes the (memory mapped) tensors of the state dict instead of copying them
+    """
+    try:
+        module.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        # torch < 2.1 has no assign
+        module.load_state_dict(state_dict)
+    module.to(device)
+    module.eval()
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument("--timeline", help="timestamp of the four saved models to convert", type=str, required=True)
+    PARSER.add_argument("--out", help="bundle path (default: models/bundle-<timeline>.pt)", default=None, type=str)
+    PARSER.add_argument("--backbone", help="vision backbone of the saved models", default="resnet50", type=str)
+    PARSER.add_argument("--text_pooling", help="text tower pooling of the saved models", default="lstm", type=str)
+    PARSER.add_argument("--text_layers", help="distilbert blocks of the saved models", default=6, type=int)
+    MY_ARGS = PARSER.parse_args()
+
+    out = MY_ARGS.out if MY_ARGS.out is not None else "models/bundle-%s.pt" % MY_ARGS.timeline
+    vision_net = vision_network.VisionNet("cpu", backbone=MY_ARGS.backbone, pretrained=False)
+    text_net = text_network.TextNet("cpu", pooling=MY_ARGS.text_pooling, nb_layers=MY_ARGS.text_layers)
+    teacher_net1 = teacher_network.TeacherNet3query(vision_net.out_features)
+    teacher_net2 = teacher_network.TeacherNet3key()
+    teacher_net1.load_state_dict(torch.load("models/enc1-t1-%s" % MY_ARGS.timeline, map_location="cpu"))
+    teacher_net2.load_state_dict(torch.load("models/enc2-t2-%s" % MY_ARGS.timeline, map_location="cpu"))
+    vision_net.model.load_state_dict(torch.load("models/enc1-%s" % MY_ARGS.timeline, map_location="cpu"))
+    text_net.model.load_state_dict(torch.load("models/enc2-%s" % MY_ARGS.timeline, map_location="cpu"))
+    save_bundle(out, vision_net, text_net, teacher_net1, teacher_net2)
+
+    start = time.time()
+    load_bundle(out)
+    print("wrote %s, loading it back took %.2fs" % (out, time.time() - start))
@@ -4,21 +4,15 @@ import GPUtil
 import sys
 import time
 import multiprocessing
-import train
+import utils
 import train_two_encoders
 import train_queue
 import train_with_att_maps
+import session_cache
 
-from knockknock import slack_sender
 
-"""
-for sending notification when your code finishes
-"""
-sys.stdin = open("webhook_url.txt", "r")
-SLACK_WEBHOOK = sys.stdin.readline().rstrip()
-
-
-@slack_sender(webhook_url=SLACK_WEBHOOK, channel="bot")
+# notifies on slack when a gpu is free, only with SLACK_NOTIFY=1 and webhook_url.txt
+@utils.slack_notifier(channel="bot")
 def query_gpu():
     while True:
         try:
@@ -32,29 +26,31 @@ def query_gpu():
 
 
 if __name__ == "__main__":
+    # cached data, tokenizer and pretrained weights are loaded by the first run only
+    SESSION = session_cache.Session()
     # query_gpu()
     # train_with_att_maps.main(att_prob_override=0.0)
     query_gpu()
-    train_with_att_maps.main(att_prob_override=0.3)
+    train_with_att_maps.main(att_prob_override=0.3, session=SESSION)
     query_gpu()
-    train_with_att_maps.main(att_prob_override=0.5)
+    train_with_att_maps.main(att_prob_override=0.5, session=SESSION)
     query_gpu()
-    train_with_att_maps.main(att_prob_override=0.7)
+    train_with_att_maps.main(att_prob_override=0.7, session=SESSION)
 
     query_gpu()
-    train_queue.main(queue_size_override=1.0)
+    train_queue.main(queue_size_override=1.0, session=SESSION)
     query_gpu()
-    train_queue.main(queue_size_override=0.7)
+    train_queue.main(queue_size_override=0.7, session=SESSION)
     query_gpu()
-    train_queue.main(queue_size_override=0.5)
+    train_queue.main(queue_size_override=0.5, session=SESSION)
     query_gpu()
-    train_queue.main(queue_size_override=0.3)
+    train_queue.main(queue_size_override=0.3, session=SESSION)
 
     query_gpu()
-    train_two_encoders.main(batch_size_override=64)
+    train_two_encoders.main(batch_size_override=64, session=SESSION)
     query_gpu()
-    train_two_encoders.main(batch_size_override=48)
+    train_two_encoders.main(batch_size_override=48, session=SESSION)
     query_gpu()
-    train_two_encoders.main(batch_size_override=32)
+    train_two_encoders.main(batch_size_override=32, session=SESSION)
     query_gpu()
-    train_two_encoders.main(batch_size_override=16)
+    train_two_encoders.main(batch_size_override=16, session=SESSION)
@@ -0,0 +1,183 @@
+import contextlib
+import fcntl
+import json
+import os
+import random
+import torch
+import numpy as np
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+import utils
+
+from torch.utils.data import Dataset
+
+# 2: lstm packed over the real tokens only, the lstm weights are saved with the features
+STORE_VERSION = 2
+
+
+def process_images(id2cap, img2id, _paths, _tokenizer, _nb_caps):
+    """
+    tokenize the first captions of each image, padded over the whole batch
+    :param id2cap:
+    :param img2id:
+    :param _paths: image paths of the batch
+    :param _tokenizer:
+    :param _nb_caps: captions per image (repeated if an image has less)
+    :return: ids, captions (B * nb_caps, L), masks (B * nb_caps, L)
+    """
+    _ids = []
+    _sentences = []
+    for _p in utils.preprocess_path(_paths):
+        _ids.append(img2id[_p])
+        _caps = [s.rstrip().lower() for s in id2cap[img2id[_p]]]
+        for _idx in range(_nb_caps):
+            _sentences.append(_tokenizer.encode("[CLS] " + _caps[_idx % len(_caps)] + " [SEP]"))
+    _longest = max([len(_sen) for _sen in _sentences])
+    _captions = torch.zeros(len(_sentences), _longest, dtype=torch.long)
+    _masks = torch.zeros(len(_sentences), _longest, dtype=torch.long)
+    for _idx, _sen in enumerate(_sentences):
+        _captions[_idx, :len(_sen)] = torch.tensor(_sen, dtype=torch.long)
+        _masks[_idx, :len(_sen)] = 1
+    return _ids, _captions, _masks
+
+
+def extract_features(vision_net, text_net, id2cap, img2id, tokenizer, device, device2=None,
+                     store_dir="cached_data/features_train", image_dir="dataset/images/train",
+                     batch_size=64, nb_caps=5):
+    """
+    run the frozen backbones once over the training set and write their outputs into .npy
+    files which are memory mapped at training time
+    :param vision_net: VisionNet
+    :param text_net: TextNet
+    :param id2cap:
+    :param img2id:
+    :param tokenizer:
+    :param device: device of the vision net
+    :param device2: device of the text net (default: device)
+    :param store_dir: where to write the store
+    :param image_dir:
+    :param batch_size:
+    :param nb_caps: captions stored per image
+    :return:
+    """
+    if device2 is None:
+        device2 = device
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    datasets.ImageFolder.__getitem__ = utils.new_get
+    dataset = datasets.ImageFolder(image_dir, transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                             std=[0.229, 0.224, 0.225]),
+    ]))
+    dataset.samples = [s for s in dataset.samples if utils.preprocess_path([s[0]])[0] in img2id]
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                         num_workers=2, pin_memory=True)
+
+    nb_images = len(dataset)
+    img_store = np.lib.format.open_memmap(os.path.join(store_dir, "img.npy"), mode="w+",
+                                          dtype=np.float32, shape=(nb_images, vision_net.out_features))
+    txt_store = np.lib.format.open_memmap(os.path.join(store_dir, "txt.npy"), mode="w+",
+                                          dtype=np.float32, shape=(nb_images, nb_caps, 768))
+    ids = np.zeros(nb_images, dtype=np.int64)
+
+    vision_net.model.eval()
+    text_net.model.eval()
+    start = 0
+    with torch.no_grad():
+        for step, (images, paths) in enumerate(loader):
+            _ids, _captions, _masks = process_images(id2cap, img2id, paths, tokenizer, nb_caps)
+            end = start + images.size(0)
+            img_store[start: end] = vision_net.forward(images.to(device)).cpu().numpy()
+            txt_feature = text_net.forward(_captions.to(device2), _masks.to(device2))
+            txt_store[start: end] = txt_feature.view(images.size(0), nb_caps, -1).cpu().numpy()
+            ids[start: end] = _ids
+            start = end
+            if step % 20 == 0:
+                print("extracted features of %d/%d images" % (start, nb_images))
+
+    img_store.flush()
+    txt_store.flush()
+    del img_store
+    del txt_store
+    # the lstm is not pretrained, the text features only hold with the weights they were computed with
+    if hasattr(text_net.model, "lstm"):
+        torch.save(text_net.model.lstm.state_dict(), os.path.join(store_dir, "lstm.pt"))
+    with open(os.path.join(store_dir, "meta.json"), "w") as fp:
+        json.dump(store_meta(vision_net, text_net), fp)
+    # written last so that a store without ids.npy is known to be incomplete
+    np.save(os.path.join(store_dir, "ids.npy"), ids)
+
+
+def store_meta(vision_net, text_net):
+    """
+    :return: what the features of a store depend on
+    """
+    return {"version": STORE_VERSION, "backbone": vision_net.backbone, "pooling": text_net.model.pooling,
+            "nb_layers": text_net.model.config.n_layers}
+
+
+def store_dir_for(backbone="resnet50", pooling="lstm", nb_layers=6):
+    """
+    each tower configuration gets its own store
+    :param backbone: vision backbone
+    :param pooling: text tower pooling
+    :param nb_layers: distilbert blocks of the text tower
+    :return:
+    """
+    return "cached_data/features_train_v%d_%s_%s%d" % (STORE_VERSION, backbone, pooling, nb_layers)
+
+
+def store_exists(store_dir, vision_net, text_net):
+    """
+    :return: if the store is complete and was extracted by towers of the same configuration
+    """
+    if not os.path.exists(os.path.join(store_dir, "ids.npy")):
+        return False
+    with open(os.path.join(store_dir, "meta.json")) as fp:
+        return json.load(fp) == store_meta(vision_net, text_net)
+
+
+@contextlib.contextmanager
+def store_lock(store_dir):
+    """
+    held while checking and extracting a store, so that concurrent runs (sweep.py) extract it once
+    and the others wait for it
+    """
+    if not os.path.exists(os.path.dirname(store_dir)):
+        os.makedirs(os.path.dirname(store_dir))
+    with open(store_dir + ".lock", "w") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def load_text_state(store_dir, text_net):
+    """
+    give text_net the lstm the text features of the store were computed with, so that validation
+    and the saved models use the same text tower as the heads were trained on
+    """
+    if hasattr(text_net.model, "lstm"):
+        text_net.model.lstm.load_state_dict(torch.load(os.path.join(store_dir, "lstm.pt"), map_location="cpu"))
+
+
+class FeatureDataset(Dataset):
+    """
+    Backbone features of every image and its captions, read from the memory mapped store.
+    Each item is the image feature and the feature of one of its captions chosen at random.
+    """
+    def __init__(self, store_dir="cached_data/features_train"):
+        self.img = np.load(os.path.join(store_dir, "img.npy"), mmap_mode="r")
+        self.txt = np.load(os.path.join(store_dir, "txt.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(store_dir, "ids.npy"))
+
+    def __len__(self):
+        return self.img.shape[0]
+
+    def __getitem__(self, index):
+        _cap = random.randrange(self.txt.shape[1])
+        return torch.from_numpy(np.array(self.img[index])), torch.from_numpy(np.array(self.txt[index, _cap]))
@@ -1,19 +1,35 @@
 import torch
 import torch.nn.functional
 import utils
+import bundle
 import text_network
 import teacher_network
 import vision_network
 import time
 import random
 import numpy as np
+import argparse
 import sys
 
 from torch.utils.data import TensorDataset, DataLoader, SequentialSampler
 
-val_img = torch.load("cached_data/val_img")
-val_cap = torch.load("cached_data/val_cap")
-val_mask = torch.load("cached_data/val_mask")
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument("--device", help="where to run the encoders", default="cuda:0", type=str)
+PARSER.add_argument("--bf16", help="if encoding with bfloat16 autocast", default=0, type=int)
+PARSER.add_argument("--check", help="with bf16, also encode in float32 and compare the accuracy", default=0, type=int)
+PARSER.add_argument("--tolerance", help="max accuracy drop of bf16 against float32", default=0.01, type=float)
+PARSER.add_argument("--text_pooling", help="text tower pooling: lstm, mean or cls", default="lstm", type=str)
+PARSER.add_argument("--text_layers", help="number of distilbert blocks of the text tower", default=6, type=int)
+PARSER.add_argument("--backbone", help="vision backbone, one of vision_network.BACKBONES", default="resnet50",
+                    type=str)
+PARSER.add_argument("--bundle", help="checkpoint bundle to evaluate (see bundle.py)", default=None, type=str)
+PARSER.add_argument("--timeline", help="without --bundle, timestamp of the four saved models", default="20191219-111227",
+                    type=str)
+MY_ARGS = PARSER.parse_args()
+
+val_img = utils.load_cached("val_img")
+val_cap = utils.load_cached("val_cap")
+val_mask = utils.load_cached("val_mask")
 
 print("Loaded val data", val_img.size(), val_cap.size(), val_mask.size())
 
@@ -24,54 +40,71 @@ valid_data = TensorDataset(val_img, val_cap, val_mask)
 valid_sampler = SequentialSampler(valid_data)
 valid_dataloader = DataLoader(valid_data, sampler=valid_sampler, batch_size=BATCH_SIZE * 2, num_workers=2)
 
-device = "cuda:0"
-text_net = text_network.TextNet(device)
-vision_net = vision_network.VisionNet(device)
+device = MY_ARGS.device
+if MY_ARGS.bundle is not None:
+    vision_net, teacher_net1, text_net, teacher_net2 = bundle.load_bundle(MY_ARGS.bundle, device)
+    MY_ARGS.text_pooling, MY_ARGS.text_layers = text_net.model.pooling, text_net.model.config.n_layers
+else:
+    text_net = text_network.TextNet(device, pooling=MY_ARGS.text_pooling, nb_layers=MY_ARGS.text_layers)
+    vision_net = vision_network.VisionNet(device, backbone=MY_ARGS.backbone, pretrained=False)
 
-teacher_net1 = teacher_network.TeacherNet3query()
-teacher_net2 = teacher_network.TeacherNet3key()
-teacher_net1.to(device)
-teacher_net2.to(device)
+    teacher_net1 = teacher_network.TeacherNet3query(vision_net.out_features)
+    teacher_net2 = teacher_network.TeacherNet3key()
+    teacher_net1.to(device)
+    teacher_net2.to(device)
 
-timeline = "20191219-111227"
-teacher_net1.load_state_dict(torch.load("models/enc1-t1-%s" % timeline))
-teacher_net2.load_state_dict(torch.load("models/enc2-t2-%s" % timeline))
-vision_net.model.load_state_dict(torch.load("models/enc1-%s" % timeline))
-text_net.model.load_state_dict(torch.load("models/enc2-%s" % timeline))
+    timeline = MY_ARGS.timeline
+    teacher_net1.load_state_dict(torch.load("models/enc1-t1-%s" % timeline, map_location=device))
+    teacher_net2.load_state_dict(torch.load("models/enc2-t2-%s" % timeline, map_location=device))
+    vision_net.model.load_state_dict(torch.load("models/enc1-%s" % timeline, map_location=device))
+    text_net.model.load_state_dict(torch.load("models/enc2-%s" % timeline, map_location=device))
 
 text_net.model.eval()
 vision_net.model.eval()
 teacher_net1.eval()
 teacher_net2.eval()
 
+
+def encode(bf16):
+    img_vecs = []
+    txt_vecs = []
+    with torch.no_grad(), utils.autocast(device, bf16):
+        for step, batch in enumerate(valid_dataloader):
+            img, cap, mask = tuple(t.to(device) for t in batch)
+            img_vec = teacher_net1.forward(vision_net.forward(img))
+            txt_vec = teacher_net2.forward(text_net.forward(cap, mask))
+
+            img_vecs.append(img_vec.float())
+            txt_vecs.append(txt_vec.float())
+    return torch.cat(img_vecs, dim=0), torch.cat(txt_vecs, dim=0)
+
+
+def query_latency(bf16, nb_queries=100):
+    """
+    average time to encode one caption query, in ms
+    """
+    with torch.no_grad(), utils.autocast(device, bf16):
+        start = time.time()
+        for idx in range(nb_queries):
+            idx = idx % val_cap.size(0)
+            cap, mask = val_cap[idx][None].to(device), val_mask[idx][None].to(device)
+            teacher_net2.forward(text_net.forward(cap, mask)).cpu()
+    return (time.time() - start) * 1000 / nb_queries
+
+
 print("Start to evaluate")
-img_vecs = []
-txt_vecs = []
-with torch.no_grad():
-    for step, batch in enumerate(valid_dataloader):
-        img, cap, mask = tuple(t.to(device) for t in batch)
-        img_vec = teacher_net1.forward(vision_net.forward(img))
-        txt_vec = teacher_net2.forward(text_net.forward(cap, mask))
-
-        img_vecs.append(img_vec)
-        txt_vecs.append(txt_vec)
-
-img_vecs = torch.cat(img_vecs, dim=0)
-txt_vecs = torch.cat(txt_vecs, dim=0)
-
-correct = 0
-correctn = 0
-
-count = 0
-for du1 in range(img_vecs.size(0)):
-    preds = []
-    count += 1
-    for du2 in range(img_vecs.size(0)):
-        preds.append(torch.matmul(img_vecs[du1].view(1, 100), txt_vecs[du2].view(100, 1)).item())
-    if np.argmax(preds) == du1:
-        correct += 1
-    if du1 in np.argsort(preds)[-64:]:
-        correctn += 1
-    print("done %d: %d, %d/%d" % (count, correct, correctn, img_vecs.size(0)))
-print("Top 1 accuracy: %.3f (%d/%d)" % (float(correct)/img_vecs.size(0), correct, img_vecs.size(0)))
-print("Top n accuracy: %.3f (%d/%d)" % (float(correctn)/img_vecs.size(0), correctn, img_vecs.size(0)))
+img_vecs, txt_vecs = encode(MY_ARGS.bf16 == 1)
+total, correct, correctn = utils.retrieval_accuracy(img_vecs, txt_vecs, 64)
+print("Top 1 accuracy: %.3f (%d/%d)" % (float(correct)/total, correct, total))
+print("Top n accuracy: %.3f (%d/%d)" % (float(correctn)/total, correctn, total))
+print("Text tower %s pooling, %d layers: %.2f ms per caption query" % (MY_ARGS.text_pooling, MY_ARGS.text_layers,
+                                                                      query_latency(MY_ARGS.bf16 == 1)))
+
+if MY_ARGS.bf16 == 1 and MY_ARGS.check == 1:
+    ref_img_vecs, ref_txt_vecs = encode(False)
+    _, ref_correct, ref_correctn = utils.retrieval_accuracy(ref_img_vecs, ref_txt_vecs, 64)
+    diff1 = float(ref_correct - correct) / total
+    diffn = float(ref_correctn - correctn) / total
+    print("float32 top 1 accuracy: %.3f, top n accuracy: %.3f" % (float(ref_correct)/total, float(ref_correctn)/total))
+    print("bf16 accuracy drop: top 1 %.4f, top n %.4f (tolerance %.4f)" % (diff1, diffn, MY_ARGS.tolerance))
+    assert diff1 <= MY_ARGS.tolerance and diffn <= MY_ARGS.tolerance, "bf16 retrieval is out of tolerance"
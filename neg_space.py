@@ -0,0 +1,418 @@
+import torch
+import numpy as np
+import threading
+import queue
+import time
+
+
+def pad_tokens(_sentences, longest_len=None):
+    """
+    pad token lists to the same length without touching the input lists
+    :param _sentences: list of token lists
+    :param longest_len: pad to this length (default: longest sentence)
+    :return: tokens and masks as long tensors
+    """
+    if longest_len is None:
+        longest_len = max([len(_sen) for _sen in _sentences])
+    _tokens = torch.zeros(len(_sentences), longest_len, dtype=torch.long)
+    _masks = torch.zeros(len(_sentences), longest_len, dtype=torch.long)
+    for _idx, _sen in enumerate(_sentences):
+        _tokens[_idx, :len(_sen)] = torch.tensor(_sen, dtype=torch.long)
+        _masks[_idx, :len(_sen)] = 1
+    return _tokens, _masks
+
+
+class NegChunk:
+    """
+    One negative space precompiled into contiguous padded tensors, owners gives the image of
+    every row
+    """
+    def __init__(self, neg_space, id2cap, tokenizer, text2tokens=None):
+        """
+        :param neg_space: image ids of the negative space
+        :param id2cap: image id to captions
+        :param tokenizer: distilbert tokenizer
+        :param text2tokens: caption to token list, shared between chunks to tokenize each caption once
+        """
+        if text2tokens is None:
+            text2tokens = {}
+        self.captions = []
+        _owners = []
+        _sentences = []
+        for _neg_img_id in neg_space:
+            _neg_img_id = int(_neg_img_id)
+            for _cap in id2cap[_neg_img_id]:
+                _cap = _cap.rstrip().lower()
+                if _cap not in text2tokens:
+                    text2tokens[_cap] = tokenizer.encode("[CLS] " + _cap + " [SEP]")
+                self.captions.append(_cap)
+                _owners.append(_neg_img_id)
+                _sentences.append(text2tokens[_cap])
+        self.owners = torch.tensor(_owners, dtype=torch.long)
+        self.tokens, self.masks = pad_tokens(_sentences)
+
+    def __len__(self):
+        return len(self.captions)
+
+
+class NegSpaceCache:
+    """
+    Embeddings of every caption in the current negative space. The whole space is encoded
+    once when it is loaded, after that only a rolling fraction of the rows is re-encoded every
+    few steps, plus the rows which are older than the staleness budget.
+    """
+    def __init__(self, refresh_every=10, refresh_frac=0.1, max_staleness=200, batch_size=32, device="cpu"):
+        """
+        :param refresh_every: refresh the cache every this many steps
+        :param refresh_frac: fraction of rows to re-encode at each refresh
+        :param max_staleness: rows older than this (in steps) are always re-encoded
+        :param batch_size: how many captions to encode at once
+        :param device: where the tokens and embeddings live
+        """
+        self.refresh_every = max(1, refresh_every)
+        self.refresh_frac = refresh_frac
+        self.max_staleness = max_staleness
+        self.batch_size = batch_size
+        self.device = device
+
+        self.chunk = None
+        self.captions = []
+        self.owners = None
+        self.tokens = None
+        self.masks = None
+        self.lengths = None
+        self.vecs = None
+        self.last_update = None
+        self.cursor = 0
+        self.step = 0
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.captions)
+
+    def reset_stats(self):
+        self.nb_encoded = 0
+        self.nb_refreshes = 0
+        self.age_sum = 0.0
+        self.age_max = 0
+        self.nb_age_samples = 0
+
+    def load(self, chunk, text_model_func):
+        """
+        switch to a new negative space and encode all of it
+        :param chunk: NegChunk
+        :param text_model_func: captions, masks, sorted_lengths -> embeddings
+        :return:
+        """
+        self.chunk = chunk
+        self.captions = chunk.captions
+        self.owners = chunk.owners.to(self.device)
+        self.tokens, self.masks = chunk.tokens.to(self.device), chunk.masks.to(self.device)
+        self.lengths = chunk.masks.sum(1)
+        self.vecs = None
+        self.last_update = torch.zeros(len(self.captions), dtype=torch.long)
+        self.cursor = 0
+        self.encode_rows(torch.arange(len(self.captions)), text_model_func)
+
+    def encode_rows(self, rows, text_model_func):
+        """
+        re-encode some rows of the cache
+        :param rows: indices of the rows
+        :param text_model_func: captions, masks, sorted_lengths -> embeddings
+        :return:
+        """
+        # sorted by length so that each batch is cut to its own longest caption
+        rows = rows[torch.argsort(self.lengths[rows], descending=True)]
+        with torch.no_grad():
+            for _start in range(0, rows.size(0), self.batch_size):
+                _rows = rows[_start: _start + self.batch_size]
+                _rows_dev = _rows.to(self.device)
+                _len = int(self.lengths[_rows[0]])
+                _neg_vec = text_model_func(self.tokens[_rows_dev, :_len], self.masks[_rows_dev, :_len],
+                                           sorted_lengths=True).detach()
+                if self.vecs is None:
+                    self.vecs = torch.zeros(len(self.captions), _neg_vec.size(-1),
+                                            dtype=_neg_vec.dtype, device=self.device)
+                self.vecs[_rows_dev] = _neg_vec.view(_rows.size(0), -1).to(self.vecs.dtype)
+        self.last_update[rows] = self.step
+        self.nb_encoded += rows.size(0)
+
+    def refresh(self, text_model_func):
+        """
+        called once per training step, re-encodes the next rolling window of rows
+        when it is due and every row which went over the staleness budget
+        :param text_model_func: captions, masks, sorted_lengths -> embeddings
+        :return: number of re-encoded rows
+        """
+        self.step += 1
+        _nb_rows = len(self.captions)
+        _rows = torch.zeros(0, dtype=torch.long)
+        if self.step % self.refresh_every == 0 and self.refresh_frac > 0:
+            _window = min(_nb_rows, max(1, int(np.ceil(_nb_rows * self.refresh_frac))))
+            _rows = (torch.arange(_window) + self.cursor) % _nb_rows
+            self.cursor = (self.cursor + _window) % _nb_rows
+        if self.max_staleness > 0:
+            _stale = torch.nonzero(self.step - self.last_update > self.max_staleness).view(-1)
+            _rows = torch.unique(torch.cat([_rows, _stale]))
+        if _rows.size(0) > 0:
+            self.encode_rows(_rows, text_model_func)
+            self.nb_refreshes += 1
+
+        _ages = self.ages()
+        self.age_sum += _ages.float().mean().item()
+        self.age_max = max(self.age_max, _ages.max().item())
+        self.nb_age_samples += 1
+        return _rows.size(0)
+
+    def ages(self):
+        """
+        :return: age in steps of every row
+        """
+        return self.step - self.last_update
+
+    def mine(self, img_vecs, img_ids, nb_neg=10, index=None):
+        """
+        pick the hardest negatives for a whole batch, captions of the image itself are never picked.
+        Without an index the whole cache is scored with one matmul, with an index only its
+        candidates are re-scored against the current embeddings, the samples with less than nb_neg
+        valid candidates fall back to the whole cache.
+        :param img_vecs: (N, C) image embeddings
+        :param img_ids: image id of each sample
+        :param nb_neg: how many negatives per sample
+        :param index: optional AsyncIVFIndex over the rows of the cache
+        :return: (N, nb_neg) row indices into the cache
+        """
+        _img_ids = torch.as_tensor(np.asarray(img_ids, dtype=np.int64), device=self.device)
+        with torch.no_grad():
+            _img_vecs = img_vecs.to(self.vecs.dtype)
+            if index is None:
+                _scores = torch.mm(_img_vecs, self.vecs.t())
+                _scores.masked_fill_(_img_ids.view(-1, 1) == self.owners.view(1, -1), float("-inf"))
+                return torch.topk(_scores, min(nb_neg, _scores.size(1)), dim=1).indices
+
+            # an image has at most a handful of captions, so a few extra candidates are enough
+            _cands = index.search(_img_vecs, nb_neg + 8).to(self.device)
+            _valid = _cands >= 0
+            _cands = _cands.clamp(min=0)
+            _scores = torch.bmm(self.vecs[_cands], _img_vecs.unsqueeze(2)).squeeze(2)
+            _scores.masked_fill_(~_valid | (self.owners[_cands] == _img_ids.view(-1, 1)), float("-inf"))
+            _best = torch.topk(_scores, min(nb_neg, self.vecs.size(0)), dim=1)
+            _rows = torch.gather(_cands, 1, _best.indices)
+            # too few valid candidates of other images, the index would hand out row 0 or an own caption
+            _short = torch.isinf(_best.values).any(1)
+            if _short.any():
+                _rows[_short] = self.mine(img_vecs[_short], _img_ids[_short].cpu().numpy(), nb_neg)
+            return _rows
+
+    def age_stats(self):
+        """
+        statistics since the last reset_stats()
+        :return: mean age, max age, rows encoded, number of refreshes
+        """
+        _mean_age = self.age_sum / self.nb_age_samples if self.nb_age_samples > 0 else 0.0
+        return _mean_age, self.age_max, self.nb_encoded, self.nb_refreshes
+
+
+class IVFIndex:
+    """
+    Inverted file index over normalized embeddings: rows are bucketed by their nearest
+    k-means centroid and a query only scores the rows of its closest buckets
+    """
+    def __init__(self, vecs, nb_lists=0, nb_probe=8, nb_iter=10):
+        """
+        :param vecs: (R, C) embeddings, a snapshot which is not modified afterwards
+        :param nb_lists: number of buckets (0 for sqrt of the number of rows)
+        :param nb_probe: how many buckets a query visits
+        :param nb_iter: k-means iterations
+        """
+        _nb_rows = vecs.size(0)
+        if nb_lists <= 0:
+            nb_lists = int(np.sqrt(_nb_rows))
+        nb_lists = max(1, min(nb_lists, _nb_rows))
+        self.vecs = vecs
+        self.nb_probe = min(nb_probe, nb_lists)
+
+        with torch.no_grad():
+            _centroids = vecs[torch.randperm(_nb_rows, device=vecs.device)[:nb_lists]].clone()
+            for _ in range(nb_iter):
+                _assign = torch.argmax(torch.mm(vecs, _centroids.t()), dim=1)
+                _sums = torch.zeros_like(_centroids).index_add_(0, _assign, vecs)
+                _counts = torch.bincount(_assign, minlength=nb_lists)
+                _filled = _counts > 0
+                _centroids[_filled] = torch.nn.functional.normalize(_sums[_filled], dim=1)
+            _assign = torch.argmax(torch.mm(vecs, _centroids.t()), dim=1)
+            _counts = torch.bincount(_assign, minlength=nb_lists)
+
+            # bucket i holds rows lists[i, :counts[i]], the rest is padded with -1
+            _order = torch.argsort(_assign)
+            _starts = torch.cumsum(_counts, 0) - _counts
+            _pos = torch.arange(_nb_rows, device=vecs.device) - _starts[_assign[_order]]
+            self.lists = torch.full((nb_lists, int(_counts.max().item())), -1, dtype=torch.long, device=vecs.device)
+            self.lists[_assign[_order], _pos] = _order
+        self.centroids = _centroids
+
+    def search(self, queries, k):
+        """
+        :param queries: (N, C)
+        :param k: number of neighbours
+        :return: (N, k) row indices, -1 where less than k rows were visited
+        """
+        with torch.no_grad():
+            _probe = torch.topk(torch.mm(queries, self.centroids.t()), self.nb_probe, dim=1).indices
+            _cands = self.lists[_probe].view(queries.size(0), -1)
+            _scores = torch.bmm(self.vecs[_cands.clamp(min=0)], queries.unsqueeze(2)).squeeze(2)
+            _scores.masked_fill_(_cands < 0, float("-inf"))
+            _k = min(k, _cands.size(1))
+            _top = torch.topk(_scores, _k, dim=1)
+            _res = torch.gather(_cands, 1, _top.indices)
+            _res[torch.isinf(_top.values)] = -1
+            if _k < k:
+                _res = torch.cat([_res, _res.new_full((_res.size(0), k - _k), -1)], dim=1)
+        return _res
+
+
+class AsyncIVFIndex:
+    """
+    IVFIndex which is rebuilt from a snapshot of the cache every few steps in a background
+    thread, searches keep using the previous index until the new one is ready
+    """
+    def __init__(self, rebuild_every=500, nb_lists=0, nb_probe=8):
+        self.rebuild_every = max(1, rebuild_every)
+        self.nb_lists = nb_lists
+        self.nb_probe = nb_probe
+        self.index = None
+        self.step = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nb_builds = 0
+        self.build_time = 0.0
+        self.nb_queries = 0
+        self.search_time = 0.0
+
+    def build(self, vecs):
+        _start = time.time()
+        _index = IVFIndex(vecs, self.nb_lists, self.nb_probe)
+        with self.lock:
+            self.index = _index
+            self.nb_builds += 1
+            self.build_time += time.time() - _start
+
+    def rebuild(self, vecs):
+        """
+        build the index right away, used after the cache was (re)loaded
+        :param vecs: embeddings of the cache
+        :return:
+        """
+        self.join()
+        self.build(vecs.clone())
+
+    def maybe_rebuild(self, vecs):
+        """
+        called once per training step, starts a background rebuild when it is due
+        :param vecs: embeddings of the cache
+        :return:
+        """
+        self.step += 1
+        if self.step % self.rebuild_every != 0:
+            return
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.build, args=(vecs.clone(),), daemon=True)
+        self.thread.start()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def search(self, queries, k):
+        with self.lock:
+            _index = self.index
+        _start = time.time()
+        _res = _index.search(queries, k)
+        self.search_time += time.time() - _start
+        self.nb_queries += queries.size(0)
+        return _res
+
+    def stats(self):
+        """
+        statistics since the last reset_stats()
+        :return: number of builds, average build time (s), average search time per query (ms)
+        """
+        _build = self.build_time / self.nb_builds if self.nb_builds > 0 else 0.0
+        _query = 1000 * self.search_time / self.nb_queries if self.nb_queries > 0 else 0.0
+        return self.nb_builds, _build, _query
+
+
+class AsyncMiner:
+    """
+    Producer thread which runs prepare_func (tokenizing, encoding the images and mining the
+    negatives) on upcoming batches and keeps the results in a bounded queue for the trainer
+    """
+    def __init__(self, prepare_func, prefetch=2):
+        """
+        :param prepare_func: loader batch -> prepared batch
+        :param prefetch: max number of prepared batches waiting in the queue
+        """
+        self.prepare_func = prepare_func
+        self.queue = queue.Queue(maxsize=max(1, prefetch))
+        self.lock = threading.Lock()
+        self.thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stall_time = 0.0
+        self.nb_batches = 0
+
+    def _run(self, batches):
+        try:
+            for _batch in batches:
+                with self.lock:
+                    _item = self.prepare_func(_batch)
+                self.queue.put(_item)
+        except Exception as _e:
+            self.queue.put(_e)
+            return
+        self.queue.put(None)
+
+    def start(self, batches):
+        """
+        start producing one pass over the batches, e.g. one epoch of the train loader
+        :param batches: iterable of loader batches
+        :return:
+        """
+        self.thread = threading.Thread(target=self._run, args=(iter(batches),), daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        while True:
+            _start = time.time()
+            _item = self.queue.get()
+            self.stall_time += time.time() - _start
+            if _item is None:
+                self.thread.join()
+                return
+            if isinstance(_item, Exception):
+                raise _item
+            self.nb_batches += 1
+            yield _item
+
+    def sync(self, sync_func):
+        """
+        run sync_func (e.g. copying the trained weights into the snapshot) between two batches
+        of the producer
+        :param sync_func:
+        :return:
+        """
+        with self.lock:
+            sync_func()
+
+    def stats(self):
+        """
+        statistics since the last reset_stats()
+        :return: total time the trainer waited (s), batches consumed
+        """
+        return self.stall_time, self.nb_batches
@@ -0,0 +1,538 @@
+import argparse
+import copy
+import io
+import json
+import os
+import time
+import unicodedata
+import torch
+import torch.nn as nn
+
+SPECIAL_TOKENS = ["[CLS]", "[SEP]", "[PAD]", "[MASK]", "[UNK]"]
+
+
+def fold_bn(conv, bn):
+    """
+    conv followed by batchnorm in eval mode as a single conv
+    :param conv: nn.Conv2d
+    :param bn: nn.BatchNorm2d
+    :return: new nn.Conv2d with the normalization in its weight and bias
+    """
+    folded = copy.deepcopy(conv)
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    folded.weight = nn.Parameter(conv.weight.detach() * scale.view(-1, 1, 1, 1))
+    folded.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias.detach())
+    return folded
+
+
+def fold_module(module):
+    """
+    fold every batchnorm of a module into the conv before it, in place. Covers the conv/bn attribute
+    pairs of resnets (conv1/bn1 ...) and conv, bn pairs inside nn.Sequential (downsample, mobilenet
+    and efficientnet blocks)
+    :param module:
+    :return: number of folded batchnorms
+    """
+    nb_folded = 0
+    for idx in range(1, 4):
+        conv, bn = getattr(module, "conv%d" % idx, None), getattr(module, "bn%d" % idx, None)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, "conv%d" % idx, fold_bn(conv, bn))
+            setattr(module, "bn%d" % idx, nn.Identity())
+            nb_folded += 1
+    if isinstance(module, nn.Sequential):
+        for idx in range(len(module) - 1):
+            if isinstance(module[idx], nn.Conv2d) and isinstance(module[idx + 1], nn.BatchNorm2d):
+                module[idx] = fold_bn(module[idx], module[idx + 1])
+                module[idx + 1] = nn.Identity()
+                nb_folded += 1
+    for child in module.children():
+        nb_folded += fold_module(child)
+    return nb_folded
+
+
+class Backbone(nn.Module):
+    """
+    A patched backbone (VisionNet.model, TextNet.model) with its forward_layer as forward
+    """
+    def __init__(self, model, forward_layer):
+        """
+        :param model: torchvision or transformers model
+        :param forward_layer: the function patched onto the model as forward_layer
+        """
+        super(Backbone, self).__init__()
+        self.model = model
+        self.forward_layer = forward_layer
+
+
+class ImageBackbone(Backbone):
+    # explicit arguments, fx symbolic tracing (quantize_image_encoder) cannot unpack *inputs
+    def forward(self, images):
+        return self.forward_layer(self.model, images)
+
+
+class TextBackbone(Backbone):
+    def forward(self, captions, masks):
+        return self.forward_layer(self.model, captions, masks)
+
+
+class ImageEncoder(nn.Module):
+    """
+    Inference build of the vision tower and the query head in one module: batchnorm folded
+    into the convs, channels_last layout, eval mode only
+    """
+    def __init__(self, backbone, forward_backbone, head, channels_last=True):
+        """
+        :param backbone: torchvision model of VisionNet.model, copied and folded
+        :param forward_backbone: the forward_layer function of the backbone
+        :param head: TeacherNet3query, copied
+        :param channels_last: if running the convs in channels_last memory format
+        """
+        super(ImageEncoder, self).__init__()
+        backbone = copy.deepcopy(backbone).eval()
+        self.nb_folded = fold_module(backbone)
+        if channels_last:
+            backbone.to(memory_format=torch.channels_last)
+        self.backbone = ImageBackbone(backbone, forward_backbone)
+        self.head = copy.deepcopy(head).eval()
+        self.channels_last = channels_last
+        for p in self.parameters():
+            p.requires_grad_(False)
+        self.eval()
+
+    def forward(self, images):
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return self.head(self.backbone(images))
+
+
+class TextEncoder(nn.Module):
+    """
+    Inference build of the text tower and the key head in one module, eval mode only
+    """
+    def __init__(self, model, forward_model, head):
+        """
+        :param model: transformers model of TextNet.model, copied
+        :param forward_model: the forward_layer function of the model
+        :param head: TeacherNet3key, copied
+        """
+        super(TextEncoder, self).__init__()
+        self.backbone = TextBackbone(copy.deepcopy(model).eval(), forward_model)
+        self.head = copy.deepcopy(head).eval()
+        for p in self.parameters():
+            p.requires_grad_(False)
+        self.eval()
+
+    def forward(self, captions, masks):
+        return self.head(self.backbone(captions, masks))
+
+
+def build_image_encoder(vision_net, teacher_net1, channels_last=True):
+    """
+    :param vision_net: VisionNet
+    :param teacher_net1: TeacherNet3query
+    :param channels_last:
+    :return: ImageEncoder
+    """
+    return ImageEncoder(vision_net.model, vision_net.model.forward_layer.__func__, teacher_net1, channels_last)
+
+
+def build_text_encoder(text_net, teacher_net2):
+    """
+    :param text_net: TextNet
+    :param teacher_net2: TeacherNet3key
+    :return: TextEncoder
+    """
+    return TextEncoder(text_net.model, text_net.model.forward_layer.__func__, teacher_net2)
+
+
+def quantize_text_encoder(encoder):
+    """
+    dynamic int8 quantization of every nn.Linear (distilbert, key head) and of the lstm, cpu only
+    :param encoder: TextEncoder
+    :return: quantized copy
+    """
+    return torch.quantization.quantize_dynamic(copy.deepcopy(encoder), {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+
+def quantize_image_encoder(encoder, calibration_batches):
+    """
+    static int8 quantization of the backbone convs (fx graph mode, observers calibrated on a few
+    batches, no training) and dynamic int8 quantization of the query head, cpu only
+    :param encoder: ImageEncoder
+    :param calibration_batches: list of image batches
+    :return: quantized copy
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    encoder = copy.deepcopy(encoder).cpu()
+    backbone = prepare_fx(encoder.backbone, get_default_qconfig_mapping("fbgemm"), (calibration_batches[0],))
+    with torch.no_grad():
+        for images in calibration_batches:
+            backbone(images.contiguous(memory_format=torch.channels_last) if encoder.channels_last else images)
+    encoder.backbone = convert_fx(backbone)
+    encoder.head = torch.quantization.quantize_dynamic(encoder.head, {nn.Linear}, dtype=torch.qint8)
+    return encoder
+
+
+def model_size(module):
+    """
+    :param module:
+    :return: size of the serialized state dict in MB
+    """
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def verify_image_encoder(encoder, vision_net, teacher_net1, images, atol=1e-4):
+    """
+    compare the inference build against the eval mode training modules on the same images
+    :param encoder: ImageEncoder
+    :param vision_net: VisionNet
+    :param teacher_net1: TeacherNet3query
+    :param images: batch of images on the device of the encoder
+    :param atol: max absolute difference of the embeddings
+    :return: max absolute difference
+    """
+    vision_net.model.eval()
+    teacher_net1.eval()
+    with torch.no_grad():
+        reference = teacher_net1.forward(vision_net.forward(images))
+        output = encoder(images)
+    diff = (reference - output).abs().max().item()
+    assert diff <= atol, "inference build differs from the eval modules by %g (tolerance %g)" % (diff, atol)
+    return diff
+
+
+def images_per_second(func, images, nb_steps=10):
+    with torch.no_grad():
+        func(images)
+        start = time.time()
+        for _ in range(nb_steps):
+            func(images)
+    return images.size(0) * nb_steps / (time.time() - start)
+
+
+class WordPieceTokenizer:
+    """
+    Uncased bert wordpiece tokenizer reading the vocab.txt written at export, gives the same ids as
+    DistilBertTokenizer.encode without importing transformers
+    """
+    def __init__(self, vocab_file=None, tokens=None, special_tokens=None):
+        """
+        :param vocab_file: vocab.txt, one token per line
+        :param tokens: or the tokens in id order
+        :param special_tokens: tokens added around every text, see added_special_tokens
+        """
+        if tokens is None:
+            with open(vocab_file, encoding="utf-8") as fp:
+                tokens = [token.rstrip("\n") for token in fp]
+        self.vocab = {token: idx for idx, token in enumerate(tokens)}
+        self.unk_id = self.vocab["[UNK]"]
+        if special_tokens is None:
+            special_tokens = {"prefix": [], "suffix": []}
+        self.prefix = [self.vocab[token] for token in special_tokens["prefix"]]
+        self.suffix = [self.vocab[token] for token in special_tokens["suffix"]]
+
+    @staticmethod
+    def basic_tokenize(text):
+        """
+        lower case, strip accents and split on whitespace and punctuation, special tokens are kept
+        """
+        words = []
+        for word in text.split():
+            if word in SPECIAL_TOKENS:
+                words.append(word)
+                continue
+            word = unicodedata.normalize("NFD", word.lower())
+            current = ""
+            for char in word:
+                if unicodedata.category(char) == "Mn" or unicodedata.category(char).startswith("C"):
+                    continue
+                if is_punctuation(char):
+                    if current:
+                        words.append(current)
+                    words.append(char)
+                    current = ""
+                else:
+                    current += char
+            if current:
+                words.append(current)
+        return words
+
+    def wordpiece(self, word):
+        """
+        greedy longest match first
+        """
+        if len(word) > 100:
+            return [self.unk_id]
+        ids = []
+        start = 0
+        while start < len(word):
+            end = len(word)
+            piece_id = None
+            while start < end:
+                piece = word[start: end] if start == 0 else "##" + word[start: end]
+                if piece in self.vocab:
+                    piece_id = self.vocab[piece]
+                    break
+                end -= 1
+            if piece_id is None:
+                return [self.unk_id]
+            ids.append(piece_id)
+            start = end
+        return ids
+
+    def encode(self, text):
+        ids = list(self.prefix)
+        for word in self.basic_tokenize(text):
+            if word in SPECIAL_TOKENS:
+                ids.append(self.vocab[word])
+            else:
+                ids.extend(self.wordpiece(word))
+        return ids + self.suffix
+
+
+def added_special_tokens(tokenizer):
+    """
+    the special tokens tokenizer.encode adds around every text by default ([CLS] and [SEP] for
+    transformers 2.x and 3.x, on top of the ones written in the captions)
+    :param tokenizer: DistilBertTokenizer or WordPieceTokenizer
+    :return: dict with the prefix and suffix tokens
+    """
+    if len(tokenizer.encode("")) == 0:
+        return {"prefix": [], "suffix": []}
+    tokens = {idx: token for token, idx in tokenizer.vocab.items()}
+    ids = tokenizer.encode("[UNK]")
+    position = ids.index(tokenizer.vocab["[UNK]"])
+    return {"prefix": [tokens[idx] for idx in ids[:position]], "suffix": [tokens[idx] for idx in ids[position + 1:]]}
+
+
+def is_punctuation(char):
+    code = ord(char)
+    if 33 <= code <= 47 or 58 <= code <= 64 or 91 <= code <= 96 or 123 <= code <= 126:
+        return True
+    return unicodedata.category(char).startswith("P")
+
+
+def export_encoders(image_encoder, text_encoder, tokenizer, out_dir, example_images, example_captions,
+                    example_masks):
+    """
+    trace both encoders into self-contained torchscript files next to the tokenizer vocab
+    :param image_encoder: ImageEncoder
+    :param text_encoder: TextEncoder
+    :param tokenizer: DistilBertTokenizer, its vocab is saved for WordPieceTokenizer
+    :param out_dir:
+    :param example_images: batch used for tracing
+    :param example_captions: batch used for tracing, captions of different lengths
+    :param example_masks:
+    :return:
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with torch.no_grad():
+        traced_image = torch.jit.trace(image_encoder, example_images)
+        traced_text = torch.jit.trace(text_encoder, (example_captions, example_masks), check_trace=False)
+    traced_image.save(os.path.join(out_dir, "image_encoder.pt"))
+    traced_text.save(os.path.join(out_dir, "text_encoder.pt"))
+    tokenizer.save_vocabulary(out_dir)
+    with open(os.path.join(out_dir, "special_tokens.json"), "w") as fp:
+        json.dump(added_special_tokens(tokenizer), fp)
+
+
+def verify_export(image_encoder, text_encoder, exported_image, exported_text, images, captions, masks, atol=1e-4):
+    """
+    compare the exported encoders against the modules on another batch size and other caption
+    lengths (shorter and padded longer) than the traced examples
+    :param image_encoder: ImageEncoder
+    :param text_encoder: TextEncoder
+    :param exported_image: loaded by load_encoders
+    :param exported_text:
+    :param images: traced example images
+    :param captions: traced example captions
+    :param masks:
+    :param atol: max absolute difference of the embeddings
+    :return: max absolute difference
+    """
+    nb_samples = max(1, images.size(0) // 2)
+    length = max(2, captions.size(1) // 2)
+    padding = torch.zeros(captions.size(0), 8, dtype=captions.dtype, device=captions.device)
+    text_cases = [(captions[:nb_samples], masks[:nb_samples]),
+                  (captions[:, :length], masks[:, :length]),
+                  (torch.cat([captions, padding], 1), torch.cat([masks, padding.to(masks.dtype)], 1))]
+    with torch.no_grad():
+        diffs = [(exported_image(images[:nb_samples]) - image_encoder(images[:nb_samples])).abs().max().item()]
+        for case in text_cases:
+            diffs.append((exported_text(*case) - text_encoder(*case)).abs().max().item())
+    diff = max(diffs)
+    assert diff <= atol, "exported encoders differ from the modules by %g (tolerance %g)" % (diff, atol)
+    return diff
+
+
+def load_encoders(export_dir, device="cpu"):
+    """
+    load the exported encoders, only needs torch
+    :param export_dir:
+    :param device:
+    :return: image encoder (images -> embeddings), text encoder (captions, masks -> embeddings), tokenizer
+    """
+    image_encoder = torch.jit.load(os.path.join(export_dir, "image_encoder.pt"), map_location=device)
+    text_encoder = torch.jit.load(os.path.join(export_dir, "text_encoder.pt"), map_location=device)
+    special_tokens = None
+    if os.path.exists(os.path.join(export_dir, "special_tokens.json")):
+        with open(os.path.join(export_dir, "special_tokens.json")) as fp:
+            special_tokens = json.load(fp)
+    tokenizer = WordPieceTokenizer(os.path.join(export_dir, "vocab.txt"), special_tokens=special_tokens)
+    return image_encoder.eval(), text_encoder.eval(), tokenizer
+
+
+def caption_latency(func, captions, masks, nb_queries=50):
+    """
+    :return: average ms to encode one caption
+    """
+    with torch.no_grad():
+        func(captions[:1], masks[:1])
+        start = time.time()
+        for idx in range(nb_queries):
+            idx = idx % captions.size(0)
+            func(captions[idx: idx + 1], masks[idx: idx + 1])
+    return (time.time() - start) * 1000 / nb_queries
+
+
+def smoke_quantize(backbone="resnet18", batch_size=2, nb_calibration=2):
+    """
+    quantize_image_encoder on random weights and random images, offline on cpu
+    :param backbone: one of vision_network.BACKBONES
+    :param batch_size:
+    :param nb_calibration: calibration batches
+    :return: max absolute difference between the int8 and the float embeddings
+    """
+    import teacher_network
+    import vision_network
+
+    vision_net = vision_network.VisionNet("cpu", backbone=backbone, pretrained=False)
+    teacher_net1 = teacher_network.TeacherNet3query(vision_net.out_features)
+    encoder = build_image_encoder(vision_net, teacher_net1)
+    calibration = [torch.randn(batch_size, 3, 224, 224) for _ in range(nb_calibration)]
+    quantized = quantize_image_encoder(encoder, calibration)
+    images = torch.randn(batch_size, 3, 224, 224)
+    with torch.no_grad():
+        reference, output = encoder(images), quantized(images)
+    assert output.size() == reference.size() and torch.isfinite(output).all()
+    return (reference - output).abs().max().item()
+
+
+def encode_all(image_func, text_func, images, captions, masks, batch_size=128):
+    img_vecs = []
+    txt_vecs = []
+    with torch.no_grad():
+        for start in range(0, images.size(0), batch_size):
+            img_vecs.append(image_func(images[start: start + batch_size]).float())
+            txt_vecs.append(text_func(captions[start: start + batch_size], masks[start: start + batch_size]).float())
+    return torch.cat(img_vecs), torch.cat(txt_vecs)
+
+
+if __name__ == "__main__":
+    import teacher_network
+    import text_network
+    import utils
+    import vision_network
+
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument("--what", help="fold: check the folded vision build, quantize: compare int8 against float, "
+                                       "export: trace both encoders into --out_dir, smoke: quantize the image "
+                                       "encoder of random weights", default="fold",
+                        choices=["fold", "quantize", "export", "smoke"])
+    PARSER.add_argument("--out_dir", help="where to export the encoders", default="models/exported", type=str)
+    PARSER.add_argument("--timeline", help="timestamp of the saved models", default="20191219-111227", type=str)
+    PARSER.add_argument("--backbone", help="vision backbone, one of vision_network.BACKBONES", default="resnet50",
+                        type=str)
+    PARSER.add_argument("--text_pooling", help="text tower pooling: lstm, mean or cls", default="lstm", type=str)
+    PARSER.add_argument("--text_layers", help="number of distilbert blocks of the text tower", default=6, type=int)
+    PARSER.add_argument("--device", help="where to run the encoders (quantize runs on cpu)", default="cpu", type=str)
+    PARSER.add_argument("--batchsize", help="images per batch", default=32, type=int)
+    PARSER.add_argument("--atol", help="max absolute difference against the eval modules", default=1e-4, type=float)
+    PARSER.add_argument("--nb_eval", help="validation pairs used to compare recall", default=1000, type=int)
+    PARSER.add_argument("--top_n", help="k of recall@k", default=10, type=int)
+    MY_ARGS = PARSER.parse_args()
+
+    if MY_ARGS.what == "smoke":
+        print("%s quantized, max difference against float %g" % (MY_ARGS.backbone,
+                                                                  smoke_quantize(MY_ARGS.backbone)))
+        raise SystemExit(0)
+
+    device = MY_ARGS.device if MY_ARGS.what != "quantize" else "cpu"
+    vision_net = vision_network.VisionNet(device, backbone=MY_ARGS.backbone, pretrained=False)
+    teacher_net1 = teacher_network.TeacherNet3query(vision_net.out_features)
+    teacher_net1.to(device)
+    teacher_net1.load_state_dict(torch.load("models/enc1-t1-%s" % MY_ARGS.timeline, map_location=device))
+    vision_net.model.load_state_dict(torch.load("models/enc1-%s" % MY_ARGS.timeline, map_location=device))
+    val_img = utils.load_cached("val_img")
+
+    encoder = build_image_encoder(vision_net, teacher_net1)
+    images = val_img[:MY_ARGS.batchsize].to(device)
+    if MY_ARGS.what == "fold":
+        diff = verify_image_encoder(encoder, vision_net, teacher_net1, images, MY_ARGS.atol)
+        print("folded %d batchnorms, max difference against the eval modules %g" % (encoder.nb_folded, diff))
+
+        eval_speed = images_per_second(lambda x: teacher_net1.forward(vision_net.forward(x)), images)
+        encoder_speed = images_per_second(encoder, images)
+        print("eval modules: %.1f images/s, inference build: %.1f images/s (%.2fx)" % (eval_speed, encoder_speed,
+                                                                                       encoder_speed / eval_speed))
+
+    elif MY_ARGS.what == "quantize":
+        text_net = text_network.TextNet(device, pooling=MY_ARGS.text_pooling, nb_layers=MY_ARGS.text_layers)
+        teacher_net2 = teacher_network.TeacherNet3key()
+        teacher_net2.load_state_dict(torch.load("models/enc2-t2-%s" % MY_ARGS.timeline, map_location=device))
+        text_net.model.load_state_dict(torch.load("models/enc2-%s" % MY_ARGS.timeline, map_location=device))
+        text_encoder = build_text_encoder(text_net, teacher_net2)
+        val_cap = utils.load_cached("val_cap")[:MY_ARGS.nb_eval]
+        val_mask = utils.load_cached("val_mask")[:MY_ARGS.nb_eval]
+        val_img = val_img[:MY_ARGS.nb_eval]
+
+        calibration = list(val_img[:4 * MY_ARGS.batchsize].split(MY_ARGS.batchsize))
+        q_encoder = quantize_image_encoder(encoder, calibration)
+        q_text_encoder = quantize_text_encoder(text_encoder)
+
+        results = {}
+        for name, img_enc, txt_enc in [("float", encoder, text_encoder), ("int8", q_encoder, q_text_encoder)]:
+            img_vecs, txt_vecs = encode_all(img_enc, txt_enc, val_img, val_cap, val_mask)
+            total, correct, correctn = utils.retrieval_accuracy(img_vecs, txt_vecs, MY_ARGS.top_n)
+            results[name] = (model_size(img_enc), model_size(txt_enc), images_per_second(img_enc, images),
+                             caption_latency(txt_enc, val_cap, val_mask),
+                             float(correct) / total, float(correctn) / total)
+
+        print("%-6s %12s %12s %10s %12s %8s %8s" % ("", "image MB", "text MB", "images/s", "query ms", "R@1",
+                                                    "R@%d" % MY_ARGS.top_n))
+        for name in ["float", "int8"]:
+            print("%-6s %12.1f %12.1f %10.1f %12.2f %8.3f %8.3f" % ((name,) + results[name]))
+        delta = [q - f for q, f in zip(results["int8"], results["float"])]
+        print("%-6s %12.1f %12.1f %10.1f %12.2f %8.3f %8.3f" % tuple(["delta"] + delta))
+
+    elif MY_ARGS.what == "export":
+        text_net = text_network.TextNet(device, pooling=MY_ARGS.text_pooling, nb_layers=MY_ARGS.text_layers)
+        teacher_net2 = teacher_network.TeacherNet3key()
+        teacher_net2.to(device)
+        teacher_net2.load_state_dict(torch.load("models/enc2-t2-%s" % MY_ARGS.timeline, map_location=device))
+        text_net.model.load_state_dict(torch.load("models/enc2-%s" % MY_ARGS.timeline, map_location=device))
+        text_encoder = build_text_encoder(text_net, teacher_net2)
+        val_cap = utils.load_cached("val_cap")[:MY_ARGS.batchsize].to(device)
+        val_mask = utils.load_cached("val_mask")[:MY_ARGS.batchsize].to(device)
+        export_encoders(encoder, text_encoder, text_net.tokenizer, MY_ARGS.out_dir, images, val_cap, val_mask)
+
+        start = time.time()
+        image_encoder, text_encoder2, tokenizer = load_encoders(MY_ARGS.out_dir, device)
+        print("exported to %s, loading took %.2fs" % (MY_ARGS.out_dir, time.time() - start))
+        with torch.no_grad():
+            diff_img = (image_encoder(images) - encoder(images)).abs().max().item()
+            diff_txt = (text_encoder2(val_cap, val_mask) - text_encoder(val_cap, val_mask)).abs().max().item()
+        print("max difference against the modules: images %g, captions %g" % (diff_img, diff_txt))
+        diff = verify_export(encoder, text_encoder, image_encoder, text_encoder2, images, val_cap, val_mask,
+                             MY_ARGS.atol)
+        print("max difference on another batch size and other caption lengths %g" % diff)
+        tokens = tokenizer.encode("[CLS] a man riding a horse on the beach. [SEP]")
+        assert tokens == text_net.tokenizer.encode("[CLS] a man riding a horse on the beach. [SEP]"), \
+            "the exported tokenizer does not match distilbert's"
@@ -0,0 +1,86 @@
+import pickle
+import utils
+import text_network
+import vision_network
+
+
+class Session:
+    """
+    Immutable artifacts shared by successive main() calls of the training scripts in one process:
+    cached tensors, captions, the tokenizer and an in-memory copy of the pretrained weights, so
+    that every run after the first one starts from pristine pretrained towers without reading them
+    again. A main() called without a session gets a fresh one and behaves as before.
+    """
+    def __init__(self):
+        self.tensors = {}
+        self.files = {}
+        self._tokenizer = None
+        self.vision_states = {}
+        self.text_states = {}
+        self.text_configs = {}
+
+    def load_cached(self, name, lazy=False):
+        """
+        :param name: cached tensor, see utils.load_cached
+        :param lazy: return a utils.CachedTensor handle which is only opened when it is used
+        :return:
+        """
+        if name not in self.tensors:
+            self.tensors[name] = utils.CachedTensor(name)
+        if lazy:
+            return self.tensors[name]
+        return self.tensors[name].tensor()
+
+    def read_caption(self, filename):
+        """
+        :param filename: coco caption json, see utils.read_caption
+        :return: id2cap, filename2id
+        """
+        if filename not in self.files:
+            self.files[filename] = utils.read_caption(filename)
+        return self.files[filename]
+
+    def load_pickle(self, filename):
+        if filename not in self.files:
+            with open(filename, "rb") as fp:
+                self.files[filename] = pickle.load(fp)
+        return self.files[filename]
+
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from transformers import DistilBertTokenizer
+            self._tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
+        return self._tokenizer
+
+    def vision_net(self, dev="cpu", checkpoint=0, backbone="resnet50"):
+        """
+        VisionNet with the pretrained weights, read from disk by the first call only
+        """
+        if backbone not in self.vision_states:
+            vision_net = vision_network.VisionNet(dev, checkpoint=checkpoint, backbone=backbone)
+            self.vision_states[backbone] = clone_state(vision_net.model.state_dict())
+            return vision_net
+        vision_net = vision_network.VisionNet(dev, checkpoint=checkpoint, backbone=backbone, pretrained=False)
+        vision_net.model.load_state_dict(self.vision_states[backbone])
+        return vision_net
+
+    def text_net(self, dev="cpu", checkpoint=0, pooling="lstm", nb_layers=6):
+        """
+        TextNet with the pretrained distilbert weights, read from disk by the first call only. The lstm
+        is not pretrained and gets a new initialization every time.
+        """
+        if nb_layers not in self.text_states:
+            text_net = text_network.TextNet(dev, checkpoint=checkpoint, pooling=pooling, nb_layers=nb_layers)
+            self.text_configs[nb_layers] = text_net.model.config.to_dict()
+            state = text_net.model.state_dict()
+            self.text_states[nb_layers] = clone_state({name: state[name] for name in state
+                                                       if not name.startswith("lstm.")})
+            return text_net
+        text_net = text_network.TextNet(dev, checkpoint=checkpoint, pooling=pooling,
+                                        config=self.text_configs[nb_layers], tokenizer=self.tokenizer())
+        text_net.model.load_state_dict(self.text_states[nb_layers], strict=False)
+        return text_net
+
+
+def clone_state(state_dict):
+    return {name: value.detach().to("cpu", copy=True) for name, value in state_dict.items()}
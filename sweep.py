@@ -0,0 +1,162 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+
+"""
+run a grid of training configurations as concurrent processes, e.g.
+python sweep.py --script train_queue.py --grid queue_size=1.0,0.7,0.5,0.3 --parallel 2 --gpus 0,1 --args "--multi 0"
+"""
+
+# the train scripts only read the validation tensors from cached_data
+CACHED_TENSORS = ["val_img", "val_cap", "val_mask"]
+
+
+def parse_grid(grids):
+    """
+    :param grids: list of "name=v1,v2,..."
+    :return: list of dicts, one per point of the cartesian product
+    """
+    names = []
+    values = []
+    for grid in grids:
+        name, choices = grid.split("=", 1)
+        names.append(name)
+        values.append(choices.split(","))
+    return [dict(zip(names, point)) for point in itertools.product(*values)]
+
+
+def share_cached_data(shm_dir, cache_dir="cached_data"):
+    """
+    write the cached tensors as .npy files into shared memory, again when the tensor in cache_dir
+    is newer, the runs memory map them through utils.load_cached
+    :param shm_dir: directory on a tmpfs, e.g. /dev/shm/...
+    :param cache_dir:
+    :return:
+    """
+    if not os.path.exists(shm_dir):
+        os.makedirs(shm_dir)
+    for name in CACHED_TENSORS:
+        path = os.path.join(shm_dir, name + ".npy")
+        source = os.path.join(cache_dir, name)
+        if not os.path.exists(source) or (os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)):
+            continue
+        tmp_path = "%s.%d.tmp.npy" % (path, os.getpid())
+        np.save(tmp_path, torch.load(source).numpy())
+        os.replace(tmp_path, path)
+        print("shared %s in %s" % (name, shm_dir))
+
+
+def partition_cores(nb_slots):
+    """
+    :param nb_slots: concurrent runs
+    :return: disjoint list of cpu cores for every slot
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    per_slot = max(1, len(cores) // nb_slots)
+    return [cores[slot * per_slot: (slot + 1) * per_slot] or cores for slot in range(nb_slots)]
+
+
+def launch(script, point, fixed_args, slot_cores, gpus, run_dir, summary_path, shm_dir):
+    """
+    start one run in its own run_dir (logs, models, resumable checkpoint, figures and its output in run.log),
+    so that concurrent runs started in the same second do not write to the same files
+    """
+    command = [sys.executable, "-u", script] + fixed_args + ["--summary", summary_path, "--run_dir", run_dir]
+    for name, value in point.items():
+        command += ["--%s" % name, value]
+    env = dict(os.environ)
+    env["CACHED_DATA_DIR"] = shm_dir
+    env["OMP_NUM_THREADS"] = str(len(slot_cores))
+    env["MKL_NUM_THREADS"] = str(len(slot_cores))
+    if gpus:
+        env["CUDA_VISIBLE_DEVICES"] = gpus
+    os.makedirs(run_dir)
+    log = open(os.path.join(run_dir, "run.log"), "w")
+    proc = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env,
+                            preexec_fn=lambda: os.sched_setaffinity(0, slot_cores))
+    return proc, log
+
+
+def summary_table(points, summary_paths):
+    """
+    :return: one line per run with its grid values and results
+    """
+    names = sorted(set(itertools.chain(*[point.keys() for point in points])))
+    header = names + ["best_val_acc", "final_val_acc", "final_train_loss", "epochs", "minutes"]
+    lines = ["\t".join(header)]
+    for point, path in zip(points, summary_paths):
+        row = [point.get(name, "") for name in names]
+        if os.path.exists(path):
+            with open(path) as fp:
+                res = json.load(fp)
+            row += ["%.4f" % res["best_val_acc"] if res["best_val_acc"] is not None else "-",
+                    "%.4f" % res["final_val_acc"] if res["final_val_acc"] is not None else "-",
+                    "%.4f" % res["final_train_loss"] if res["final_train_loss"] is not None else "-",
+                    str(res["epochs"]), "%.1f" % (res["seconds"] / 60)]
+        else:
+            row += ["failed", "-", "-", "-", "-"]
+        lines.append("\t".join(row))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument("--script", help="training script to run", default="train_queue.py", type=str)
+    PARSER.add_argument("--grid", help="name=v1,v2,... of an argument to sweep, can be repeated", action="append",
+                        default=[])
+    PARSER.add_argument("--args", help="arguments passed to every run", default="", type=str)
+    PARSER.add_argument("--parallel", help="runs at the same time", default=2, type=int)
+    PARSER.add_argument("--gpus", help="comma separated gpu groups given to the slots in turn, e.g. 0,1 or 0+1,2+3",
+                        default="", type=str)
+    PARSER.add_argument("--out_dir", help="where the logs and summaries go", default="sweeps", type=str)
+    PARSER.add_argument("--shm_dir", help="shared memory directory for the cached tensors, every sweep uses its own "
+                                          "sub directory which is removed when the sweep is done",
+                        default="/dev/shm/hci_cached_data", type=str)
+    MY_ARGS = PARSER.parse_args()
+
+    points = parse_grid(MY_ARGS.grid)
+    sweep_dir = os.path.join(MY_ARGS.out_dir, "%s-%s" % (os.path.splitext(os.path.basename(MY_ARGS.script))[0],
+                                                         time.strftime("%Y%m%d-%H%M%S")))
+    os.makedirs(sweep_dir)
+    shm_dir = os.path.join(MY_ARGS.shm_dir, os.path.basename(sweep_dir))
+    share_cached_data(shm_dir)
+
+    slot_cores = partition_cores(MY_ARGS.parallel)
+    gpu_groups = [group.replace("+", ",") for group in MY_ARGS.gpus.split(",")] if MY_ARGS.gpus else [""]
+    summary_paths = [os.path.join(sweep_dir, "run-%d.json" % idx) for idx in range(len(points))]
+    pending = list(range(len(points)))
+    running = {}
+    start = time.time()
+    try:
+        while pending or running:
+            for slot in range(MY_ARGS.parallel):
+                if slot in running or not pending:
+                    continue
+                idx = pending.pop(0)
+                running[slot] = (idx,) + launch(MY_ARGS.script, points[idx], MY_ARGS.args.split(), slot_cores[slot],
+                                                gpu_groups[slot % len(gpu_groups)],
+                                                os.path.join(sweep_dir, "run-%d" % idx), summary_paths[idx],
+                                                shm_dir)
+                print("run %d %s on cores %s" % (idx, points[idx], slot_cores[slot]))
+            time.sleep(5)
+            for slot, (idx, proc, log) in list(running.items()):
+                if proc.poll() is not None:
+                    log.close()
+                    del running[slot]
+                    print("run %d finished with code %d" % (idx, proc.returncode))
+    finally:
+        # the runs have the tensors mapped, the memory is freed once the last of them exits
+        shutil.rmtree(shm_dir, ignore_errors=True)
+
+    table = summary_table(points, summary_paths)
+    with open(os.path.join(sweep_dir, "summary.tsv"), "w") as fp:
+        fp.write(table + "\n")
+    print(table)
+    print("sweep of %d runs took %.1f minutes" % (len(points), (time.time() - start) / 60))
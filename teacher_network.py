@@ -1,15 +1,39 @@
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+import functools
+
+
+def full_precision(func):
+    """
+    run a loss method in float32 even when it is called inside an autocast region
+    :param func: method of a loss with a dev attribute
+    :return:
+    """
+    def to_float(inp):
+        if torch.is_tensor(inp):
+            return inp.float()
+        if isinstance(inp, (list, tuple)):
+            return [to_float(du) for du in inp]
+        return inp
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with torch.autocast(device_type=torch.device(self.dev).type, enabled=False):
+            return func(self, *[to_float(arg) for arg in args], **kwargs)
+    return wrapper
 
 
 class TeacherNet3query(nn.Module):
     """
     encoder
     """
-    def __init__(self):
+    def __init__(self, in_features=2048):
+        """
+        :param in_features: width of the vision backbone feature (VisionNet.out_features)
+        """
         super(TeacherNet3query, self).__init__()
-        self.linear0 = nn.Linear(in_features=2048, out_features=768)
+        self.linear0 = nn.Linear(in_features=in_features, out_features=768)
         self.linear1 = nn.Linear(in_features=768, out_features=1024)
         self.linear2 = nn.Linear(in_features=1024, out_features=1024)
         self.linear3 = nn.Linear(in_features=1024, out_features=100)
@@ -23,7 +47,7 @@ class TeacherNet3query(nn.Module):
         out = F.leaky_relu(self.linear2(out))
         out = self.dropout2(out)
         out = self.linear3(out)
-        out = F.normalize(out)
+        out = F.normalize(out.float())
         return out
 
 
@@ -45,7 +69,7 @@ class TeacherNet3key(nn.Module):
         out = F.leaky_relu(self.linear2(out))
         out = self.dropout2(out)
         out = self.linear3(out)
-        out = F.normalize(out)
+        out = F.normalize(out.float())
         return out
 
 
@@ -87,7 +111,8 @@ class ContrastiveLoss(nn.Module):
         self.dev = dev
         self.loss_fn = torch.nn.CrossEntropyLoss()
 
-    def return_logits(self, q, k, queue):
+    @full_precision
+    def return_logits(self, q, k, queue, sync=True):
         N = q.size(0)
         C = q.size(1)
         K = queue.shape[0]
@@ -95,8 +120,11 @@ class ContrastiveLoss(nn.Module):
         l_neg = torch.mm(q.view(N, C), queue.T.view(-1, K))
         logits = torch.cat([l_pos.view((N, 1)), l_neg], dim=1)
         sim_diff = l_pos.squeeze()-torch.max(l_neg, dim=1).values
-        return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff).item()
+        if sync:
+            return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff).item()
+        return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff)
 
+    @full_precision
     def forward(self, q, k, queue):
         N = q.size(0)
         C = q.size(1)
@@ -119,7 +147,8 @@ class ContrastiveLossInBatch(nn.Module):
         self.dev = dev
         self.loss_fn = torch.nn.CrossEntropyLoss()
 
-    def return_logits(self, q, k):
+    @full_precision
+    def return_logits(self, q, k, sync=True):
         N = q.size(0)
         C = q.size(1)
         mask = torch.eye(N)
@@ -133,8 +162,11 @@ class ContrastiveLossInBatch(nn.Module):
         l_pos = torch.bmm(q.view(N, 1, C), k.view(N, C, 1))
         logits = torch.cat([l_pos.view((N, 1)), l_neg], dim=1)
         sim_diff = l_pos.squeeze() - torch.max(l_neg, dim=1).values
-        return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff).item()
+        if sync:
+            return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff).item()
+        return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff)
 
+    @full_precision
     def forward(self, q, k):
         N = q.size(0)
         C = q.size(1)
@@ -163,31 +195,33 @@ class ContrastiveLossReRank(nn.Module):
         self.dev = dev
         self.loss_fn = torch.nn.CrossEntropyLoss()
 
-    def return_logits(self, q, k, neg):
+    def negative_logits(self, q, neg):
+        """
+        :param q: (N, C)
+        :param neg: (N, K, C) tensor or list of N (K, C) tensors
+        :return: (N, K)
+        """
+        if isinstance(neg, (list, tuple)):
+            neg = torch.stack(neg)
+        return torch.bmm(neg, q.unsqueeze(2)).squeeze(2)
+
+    @full_precision
+    def return_logits(self, q, k, neg, sync=True):
         N = q.size(0)
         C = q.size(1)
-        K = neg[0].size(0)
-        l_neg = None
-        for idx in range(N):
-            if l_neg is None:
-                l_neg = torch.mv(neg[idx], q[idx]).view(1, K)
-            else:
-                l_neg = torch.cat([l_neg, torch.mv(neg[idx], q[idx]).view(1, K)], dim=0)
+        l_neg = self.negative_logits(q, neg)
         l_pos = torch.bmm(q.view(N, 1, C), k.view(N, C, 1))
         logits = torch.cat([l_pos.view((N, 1)), l_neg], dim=1)
         sim_diff = l_pos.squeeze() - torch.max(l_neg, dim=1).values
-        return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff).item()
+        if sync:
+            return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff).item()
+        return logits, torch.argmax(logits, dim=1), torch.mean(sim_diff)
 
+    @full_precision
     def forward(self, q, k, neg):
         N = q.size(0)
         C = q.size(1)
-        K = neg[0].size(0)
-        l_neg = None
-        for idx in range(N):
-            if l_neg is None:
-                l_neg = torch.mv(neg[idx], q[idx]).view(1, K)
-            else:
-                l_neg = torch.cat([l_neg, torch.mv(neg[idx], q[idx]).view(1, K)], dim=0)
+        l_neg = self.negative_logits(q, neg)
         l_pos = torch.bmm(q.view(N, 1, C), k.view(N, C, 1))
         logits = torch.cat([l_pos.view((N, 1)), l_neg], dim=1)
         labels = torch.zeros(N, dtype=torch.long, device=self.dev)
@@ -201,6 +235,7 @@ class IdentificationLossInBatch(nn.Module):
         self.loss_fn = torch.nn.CrossEntropyLoss()
         self.dev = dev
 
+    @full_precision
     def forward(self, q):
         N = q.size(0)
         C = q.size(1)
@@ -218,7 +253,8 @@ class IdentificationLossInBatch(nn.Module):
         loss = self.loss_fn(logits/0.07, labels)
         return loss
 
-    def compute_diff(self, q):
+    @full_precision
+    def compute_diff(self, q, sync=True):
         N = q.size(0)
         C = q.size(1)
         mask = torch.eye(N)
@@ -231,7 +267,9 @@ class IdentificationLossInBatch(nn.Module):
                 l_neg = torch.cat([l_neg, torch.mv(q[negative_sample_ids, :], q[idx]).view(1, N - 1)], dim=0)
         l_pos = torch.bmm(q.view(N, 1, C), q.view(N, C, 1))
         sim_diff = l_pos.squeeze() - torch.max(l_neg, dim=1).values
-        return torch.mean(sim_diff).item()
+        if sync:
+            return torch.mean(sim_diff).item()
+        return torch.mean(sim_diff)
 
 
 class CustomedQueue:
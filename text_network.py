@@ -1,45 +1,112 @@
-from transformers.modeling_distilbert import DistilBertForSequenceClassification
-from transformers import DistilBertTokenizer, DistilBertConfig
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler
-
+import functools
 import types
 import utils
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
+
+POOLINGS = ["lstm", "mean", "cls"]
+
+
+def forward_blocks(blocks, hidden_state, attention_mask):
+    for block in blocks:
+        hidden_state = block(hidden_state, attn_mask=attention_mask)[-1]
+    return hidden_state
+
+
+def forward_distilbert(self, input_ids, attention_mask):
+    """
+    distilbert forward with activation checkpointing, the transformer blocks are split into
+    self.checkpoint segments and only the input of each segment is kept for backward
+    :param self:
+    :param input_ids:
+    :param attention_mask:
+    :return: last hidden state (bs, seq_len, dim)
+    """
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    hidden_state = self.distilbert.embeddings(input_ids)
+    blocks = list(self.distilbert.transformer.layer)
+    segment = -(-len(blocks) // min(self.checkpoint, len(blocks)))
+    for start in range(0, len(blocks), segment):
+        run_segment = functools.partial(forward_blocks, blocks[start: start + segment])
+        hidden_state = torch.utils.checkpoint.checkpoint(run_segment, hidden_state, attention_mask,
+                                                         use_reentrant=False)
+    return hidden_state
 
 
-def forward_layer(self, input_ids, attention_mask=None, head_mask=None):
+def forward_layer(self, input_ids, attention_mask=None, head_mask=None, sorted_lengths=False):
     """
     used to forward only first components
     :param self:
     :param input_ids:
     :param attention_mask:
     :param head_mask:
+    :param sorted_lengths: if the captions are sorted by decreasing length, skips the sort when packing
     :return:
     """
-    distilbert_output = self.distilbert(input_ids=input_ids,
-                                        attention_mask=attention_mask,
-                                        head_mask=head_mask)
-    hidden_state = distilbert_output[0]  # (bs, seq_len, dim)
+    if self.checkpoint > 0 and self.training and torch.is_grad_enabled() and head_mask is None:
+        hidden_state = forward_distilbert(self, input_ids, attention_mask)
+    else:
+        distilbert_output = self.distilbert(input_ids=input_ids,
+                                            attention_mask=attention_mask,
+                                            head_mask=head_mask)
+        hidden_state = distilbert_output[0]  # (bs, seq_len, dim)
+    if self.pooling == "cls":
+        return hidden_state[:, 0]
+    if self.pooling == "mean":
+        if attention_mask is None:
+            return hidden_state.mean(1)
+        _mask = attention_mask.unsqueeze(-1).to(hidden_state.dtype)
+        return (hidden_state * _mask).sum(1) / _mask.sum(1).clamp(min=1)
+
     hidden_state = hidden_state.permute(1, 0, 2)
+    if attention_mask is not None:
+        # the lstm stops at the last real token of each caption instead of running over the padding
+        lengths = attention_mask.sum(1).clamp(min=1).cpu()
+        hidden_state = nn.utils.rnn.pack_padded_sequence(hidden_state, lengths, enforce_sorted=sorted_lengths)
     pooled_output, hidden_cell = self.lstm(hidden_state)
-    return hidden_cell[0].squeeze()
+    return hidden_cell[0][-1]
 
 
 class TextNet:
-    def __init__(self, dev="cpu"):
-        config = DistilBertConfig.from_pretrained("distilbert-base-uncased")
-        config.output_hidden_states = True
+    def __init__(self, dev="cpu", checkpoint=0, pooling="lstm", nb_layers=6, config=None, tokenizer=None):
+        """
+        :param dev:
+        :param checkpoint: activation checkpointing segments over the distilbert blocks, 0 for none,
+        6 checkpoints every block
+        :param pooling: how captions are reduced to one vector, "lstm" over the tokens, "mean" of the
+        real tokens or the "cls" token
+        :param nb_layers: only the first nb_layers distilbert blocks are kept
+        :param config: distilbert config as a dict, builds the model offline without the pretrained
+        weights (nb_layers is then taken from the config)
+        :param tokenizer: tokenizer to use along with config
+        """
+        assert pooling in POOLINGS, "unknown pooling %s" % pooling
+        # transformers is imported here so that importing the module stays cheap
+        from transformers.modeling_distilbert import DistilBertForSequenceClassification
+        from transformers import DistilBertTokenizer, DistilBertConfig
         self.no_dropout = False
-        self.tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
-        self.model = DistilBertForSequenceClassification.from_pretrained("distilbert-base-uncased", config=config)
+        if config is not None:
+            self.tokenizer = tokenizer
+            self.model = DistilBertForSequenceClassification(DistilBertConfig.from_dict(config))
+        else:
+            config = DistilBertConfig.from_pretrained("distilbert-base-uncased")
+            config.output_hidden_states = True
+            # the pretrained weights of the blocks past nb_layers are left out when loading
+            config.n_layers = nb_layers
+            self.tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
+            self.model = DistilBertForSequenceClassification.from_pretrained("distilbert-base-uncased", config=config)
         self.model.forward_layer = types.MethodType(forward_layer, self.model)
-        self.model.lstm = nn.LSTM(768, 768)
+        if pooling == "lstm":
+            self.model.lstm = nn.LSTM(768, 768)
+        self.model.pooling = pooling
+        self.model.checkpoint = checkpoint
 
         self.model.to(dev)
 
-    def forward(self, indices, masks):
-        hidden_vec2 = self.model.forward_layer(indices, masks)
+    def forward(self, indices, masks, sorted_lengths=False):
+        hidden_vec2 = self.model.forward_layer(indices, masks, sorted_lengths=sorted_lengths)
         return hidden_vec2
 
     def parameters(self):
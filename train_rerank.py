@@ -1,36 +1,28 @@
+import os
 import torch
 import utils
-import text_network
+import session_cache
+import bundle
 import teacher_network
-import vision_network
+import neg_space
 import torch.optim as optim
 import time
-import pickle
 import argparse
 import numpy as np
 import random
 import matplotlib.pyplot as plt
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
-import sys
-from transformers import DistilBertTokenizer
 from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import TensorDataset, DataLoader, RandomSampler
 from datetime import datetime
 
 
-def preprocess_captions(_captions_list):
-    res = []
-    for _cap in _captions_list:
-        res.append(_cap.rstrip().lower())
-    return res
-
-
 def fake_img_func(inp1):
     return torch.rand(inp1.size(0), 100)
 
 
-def fake_text_func(inp1, inp2):
+def fake_text_func(inp1, inp2, sorted_lengths=False):
     return torch.rand(inp1.size(0), 100)
 
 
@@ -59,120 +51,19 @@ def process_batch(id2cap, img2id, _batch, _tokenizer):
     return _images, _captions, _masks, _id
 
 
-def forward_neg_space(_neg_space, _text2vec, id2cap, _text_model_func, _tokenizer, device):
-    _neg_cap_list = []
-    for _neg_img_id in _neg_space:
-        _neg_cap_list.extend(id2cap[_neg_img_id])
-    _neg_cap_list = preprocess_captions(_neg_cap_list)
-    _neg_cap_tokenized_list = []
-    _neg_masks = []
-    longest_len = 0
-    _cap2vec = {}
-    for _cap in _neg_cap_list:
-        try:
-            _sen = _text2vec[_cap]
-        except KeyError:
-            _sen = _tokenizer.encode("[CLS] " + _cap + " [SEP]")
-            _text2vec[_cap] = _sen
-        _neg_cap_tokenized_list.append(_sen)
-        if len(_sen) > longest_len:
-            longest_len = len(_sen)
-    for _sen in _neg_cap_tokenized_list:
-        _mask = [1] * len(_sen)
-        while len(_sen) < longest_len:
-            _sen.append(0)
-            _mask.append(0)
-        _neg_masks.append(_mask)
-        assert len(_sen) == longest_len == len(_mask)
-
-    _captions, _masks = torch.from_numpy(np.array(_neg_cap_tokenized_list)), torch.from_numpy(np.array(_neg_masks))
-    _neg_data = TensorDataset(_captions, _masks, torch.arange(_captions.size(0)))
-    _neg_sampler = SequentialSampler(_neg_data)  # must not be random here
-    _neg_dataloader = DataLoader(_neg_data, sampler=_neg_sampler, batch_size=32, num_workers=5)
-
-    with torch.no_grad():
-        for _step, _batch in enumerate(_neg_dataloader):
-            _du1, _du2 = tuple(t.to(device) for t in _batch[:2])
-            _neg_vec = _text_model_func(_du1, _du2)
-            for _idx2, _idx in enumerate(_batch[2]):
-                _cap2vec[_neg_cap_list[_idx.item()]] = _neg_vec[_idx2]
-    del _du1
-    del _du2
-    del _neg_vec
-    torch.cuda.empty_cache()
-    return _cap2vec
-
-
-def sample_neg_vectors(_neg_space, _positive_img_id, _postive_img_vec, id2cap, _tokenizer, _text2vec, _cap2vec,
-                       _text_model_func,
-                       device="cpu", _nb_neg_vectors=63, clear_mem=True):
-    _neg_space = list(_neg_space)
-    try:
-        _neg_space.remove(_positive_img_id)
-    except ValueError:
-        pass
-
-    _neg_cap_list = []
-    for _neg_img_id in _neg_space:
-        _neg_cap_list.extend(id2cap[_neg_img_id])
-    _neg_cap_list = preprocess_captions(_neg_cap_list)
-    _neg_cap_tokenized_list = []
-    _neg_masks = []
-    longest_len = 0
-    for _cap in _neg_cap_list:
-        try:
-            _sen = _text2vec[_cap]
-        except KeyError:
-            _sen = _tokenizer.encode("[CLS] " + _cap + " [SEP]")
-            _text2vec[_cap] = _sen
-        _neg_cap_tokenized_list.append(_sen)
-        if len(_sen) > longest_len:
-            longest_len = len(_sen)
-    for _sen in _neg_cap_tokenized_list:
-        _mask = [1] * len(_sen)
-        while len(_sen) < longest_len:
-            _sen.append(0)
-            _mask.append(0)
-        _neg_masks.append(_mask)
-        assert len(_sen) == longest_len == len(_mask)
-
-    _captions, _masks = torch.from_numpy(np.array(_neg_cap_tokenized_list)), torch.from_numpy(np.array(_neg_masks))
-    _neg_data = TensorDataset(_captions, _masks)
-    _neg_sampler = SequentialSampler(_neg_data)  # must not be random here
-    _neg_dataloader = DataLoader(_neg_data, sampler=_neg_sampler, batch_size=int(_captions.size(0)/10), num_workers=5)
-    _neg_tracker = []
-    _all_scores = []
-
-    for _cap in _neg_cap_list:
-        _neg_vec = _cap2vec[_cap]
-        _score = torch.matmul(_postive_img_vec.view(1, 100), _neg_vec.view(100, 1)).item()
-        _all_scores.append(_score)
-
-    _res = np.argsort(_all_scores)[-_nb_neg_vectors:]
-
-    _neg_cap = _captions[_res]
-    _neg_mask = _masks[_res]
-
-    return _neg_cap.to(device), _neg_mask.to(device)
-
-
 def tokenize_neg_space(_neg_spaces, id2cap, _tokenizer):
-    _all = []
-    for _neg_space in _neg_spaces:
-        _res = {}
-        _neg_cap_list = []
-        for _neg_img_id in _neg_space:
-            _neg_cap_list.extend(id2cap[_neg_img_id])
-        _neg_cap_list = preprocess_captions(_neg_cap_list)
-        for _cap in _neg_cap_list:
-            if _cap not in _res:
-                _sen = _tokenizer.encode("[CLS] " + _cap + " [SEP]")
-                _res[_cap] = _sen
-        _all.append(_res)
-    return _all
-
-
-def main(idloss_override=None):
+    """
+    precompile every negative space into padded token tensors
+    :param _neg_spaces: list of image id arrays
+    :param id2cap:
+    :param _tokenizer:
+    :return: list of neg_space.NegChunk
+    """
+    _text2tokens = {}
+    return [neg_space.NegChunk(_neg_space, id2cap, _tokenizer, _text2tokens) for _neg_space in _neg_spaces]
+
+
+def main(idloss_override=None, session=None):
     LOGGER = utils.Logger()
     PARSER = argparse.ArgumentParser()
     PARSER.add_argument("--epochs", help="number of epochs", default=10, type=int)
@@ -186,14 +77,58 @@ def main(idloss_override=None):
     PARSER.add_argument("--idloss", help="if training with id loss", default=0, type=int)
     PARSER.add_argument("--cropping", help="if randomly crop train images", default=1, type=int)
     PARSER.add_argument("--debug", help="if debugging", default=1, type=int)
+    PARSER.add_argument("--metrics_from_train", help="if train metrics come from the training forward", default=0,
+                        type=int)
+    PARSER.add_argument("--exact_metrics_every", help="with metrics_from_train, re-forward in eval mode every n steps",
+                        default=0, type=int)
+    PARSER.add_argument("--bf16", help="if running the towers with bfloat16 autocast", default=0, type=int)
+    PARSER.add_argument("--micro_batchsize", help="split each batch into micro batches of this size (0 for none)",
+                        default=0, type=int)
+    PARSER.add_argument("--checkpoint_vision", help="activation checkpointing segments per vision stage (0 for none)",
+                        default=0, type=int)
+    PARSER.add_argument("--backbone", help="vision backbone, one of vision_network.BACKBONES", default="resnet50",
+                        type=str)
+    PARSER.add_argument("--checkpoint_text", help="activation checkpointing segments over distilbert (0 for none)",
+                        default=0, type=int)
+    PARSER.add_argument("--text_pooling", help="text tower pooling: lstm, mean or cls", default="lstm", type=str)
+    PARSER.add_argument("--text_layers", help="number of distilbert blocks of the text tower", default=6, type=int)
+    PARSER.add_argument("--ckpt_every", help="save a resumable checkpoint every n steps (0 for none)", default=0,
+                        type=int)
+    PARSER.add_argument("--ckpt_path", help="resumable checkpoint file (default: <model dir>/resume-rerank.pt)",
+                        default="", type=str)
+    PARSER.add_argument("--resume", help="if resuming from --ckpt_path", default=0, type=int)
+    PARSER.add_argument("--seed", help="seed of the training data order, -1 for a random one (a resumed run keeps "
+                                       "the seed of its checkpoint)", default=-1, type=int)
+    PARSER.add_argument("--run_dir", help="own directory of the run for its logs, models, checkpoint and figures "
+                                          "(default: the shared logs/, models/ and figures/)", default="", type=str)
+    PARSER.add_argument("--summary", help="write the results of the run to this json file", default="", type=str)
+    PARSER.add_argument("--profile", help="time the phases of every training step, 1 for on", default=0, type=int)
+    PARSER.add_argument("--profile_steps", help="steps per epoch written to the chrome trace in the log dir",
+                        default=100, type=int)
+    PARSER.add_argument("--neg_refresh_every", help="refresh the negative cache every n steps", default=10, type=int)
+    PARSER.add_argument("--neg_refresh_frac", help="fraction of the negative cache to refresh", default=0.1,
+                        type=float)
+    PARSER.add_argument("--neg_max_staleness", help="max age in steps of a cached negative (0 for no limit)",
+                        default=200, type=int)
+    PARSER.add_argument("--neg_mode", help="chunk: negatives from 1%% of the images, ann: from the whole corpus",
+                        default="chunk", type=str)
+    PARSER.add_argument("--ann_rebuild_every", help="rebuild the ann index every n steps", default=500, type=int)
+    PARSER.add_argument("--ann_lists", help="number of ann buckets (0 for sqrt of captions)", default=0, type=int)
+    PARSER.add_argument("--ann_probe", help="number of ann buckets visited per query", default=8, type=int)
+    PARSER.add_argument("--neg_async", help="if mining negatives in a background thread", default=0, type=int)
+    PARSER.add_argument("--neg_prefetch", help="number of mined batches kept ahead of training", default=2, type=int)
+    PARSER.add_argument("--neg_sync_every", help="copy the trained weights to the miner every n steps", default=10,
+                        type=int)
 
     MY_ARGS = PARSER.parse_args()
+    if session is None:
+        session = session_cache.Session()
 
     now = datetime.now()
-    if MY_ARGS.debug == 0:
-        logdir = "logs/" + now.strftime("%Y%m%d-%H%M%S") + "/"
-    else:
+    logdir, model_dir, figure_dir = utils.run_dirs(MY_ARGS.run_dir, now)
+    if MY_ARGS.debug != 0 and not MY_ARGS.run_dir:
         logdir = "logs/debug/"
+    ckpt_path = MY_ARGS.ckpt_path or os.path.join(model_dir, "resume-rerank.pt")
     WRITER = SummaryWriter(logdir)
 
     if idloss_override is not None:
@@ -203,15 +138,10 @@ def main(idloss_override=None):
     print(MY_ARGS)
     LOGGER.info("=============================================================")
 
-    train_img = torch.load("cached_data/train_img")
-    train_cap = torch.load("cached_data/train_cap")
-    train_mask = torch.load("cached_data/train_mask")
-
-    val_img = torch.load("cached_data/val_img")
-    val_cap = torch.load("cached_data/val_cap")
-    val_mask = torch.load("cached_data/val_mask")
+    val_img = session.load_cached("val_img")
+    val_cap = session.load_cached("val_cap")
+    val_mask = session.load_cached("val_mask")
 
-    print("Loaded train data", train_img.size(), train_cap.size(), train_mask.size())
     print("Loaded val data", val_img.size(), val_cap.size(), val_mask.size())
 
     BATCH_SIZE = MY_ARGS.batchsize
@@ -222,9 +152,11 @@ def main(idloss_override=None):
     valid_sampler = RandomSampler(valid_data)
     valid_dataloader = DataLoader(valid_data, sampler=valid_sampler, batch_size=BATCH_SIZE, num_workers=2)
 
-    text_net = text_network.TextNet(device)
-    vision_net = vision_network.VisionNet(device)
-    teacher_net1 = teacher_network.TeacherNet3query()
+    text_net = session.text_net(device, checkpoint=MY_ARGS.checkpoint_text, pooling=MY_ARGS.text_pooling,
+                                nb_layers=MY_ARGS.text_layers)
+    vision_net = session.vision_net(device, checkpoint=MY_ARGS.checkpoint_vision,
+                                    backbone=MY_ARGS.backbone)
+    teacher_net1 = teacher_network.TeacherNet3query(vision_net.out_features)
     teacher_net2 = teacher_network.TeacherNet3key()
     ranking_loss = teacher_network.ContrastiveLossReRank(1, device)
     ranking_loss2 = teacher_network.ContrastiveLossInBatch(1, device)
@@ -264,6 +196,20 @@ def main(idloss_override=None):
     elif MY_ARGS.optim == 2:
         optimizer = optim.Adam(teacher_net1.parameters(), lr=0.01)
 
+    MICRO_BATCHER = utils.MicroBatcher(MY_ARGS.micro_batchsize, optimizer.zero_grad,
+                                       [vision_net.model, text_net.model, teacher_net1, teacher_net2])
+    PROFILER = utils.StepProfiler(MY_ARGS.profile == 1, [device], MY_ARGS.profile_steps)
+
+    def heads_loss_func(_img_feature, _pos_feature, _neg_feature, _neg_inverse):
+        _img_vec = teacher_net1.forward(_img_feature)
+        _pos_txt_vec = teacher_net2.forward(_pos_feature)
+        _neg_txt_vecs = teacher_net2.forward(_neg_feature)[_neg_inverse]
+        _loss = ranking_loss(_img_vec, _pos_txt_vec, _neg_txt_vecs)
+        _loss_total = _loss
+        if MY_ARGS.idloss:
+            _loss_total = _loss + identification_loss(_img_vec) + identification_loss(_pos_txt_vec)
+        return _loss_total, _loss, _img_vec, _pos_txt_vec
+
     # lr_scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=[100, 150, 200], gamma=0.1)
 
     print("Start to train")
@@ -274,22 +220,101 @@ def main(idloss_override=None):
     val_accs = []
     val_sim = []
 
-    TOKENIZER = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
+    TOKENIZER = session.tokenizer()
     datasets.ImageFolder.__getitem__ = utils.new_get
 
-    with open('cached_data/id2cap_train.json', 'rb') as fp:
-        ID2CAP_TRAIN = pickle.load(fp)
-    with open('cached_data/image2id_train.json', 'rb') as fp:
-        IMAGE2ID_TRAIN = pickle.load(fp)
+    ID2CAP_TRAIN = session.load_pickle('cached_data/id2cap_train.json')
+    IMAGE2ID_TRAIN = session.load_pickle('cached_data/image2id_train.json')
 
-    def text_func(inp1, inp2):
-        something = text_net.forward(inp1, inp2)
+    def text_func(inp1, inp2, sorted_lengths=False):
+        something = text_net.forward(inp1, inp2, sorted_lengths=sorted_lengths)
         return teacher_net2.forward(something)
 
+    CHECKPOINTER = utils.Checkpointer(ckpt_path, MY_ARGS.ckpt_every)
+    state = CHECKPOINTER.load() if MY_ARGS.resume == 1 else None
+    # the seed also orders the negative chunks, a resumed run keeps the one of its checkpoint
+    if state is not None:
+        RUN_SEED = state["seed"]
+    else:
+        RUN_SEED = MY_ARGS.seed if MY_ARGS.seed >= 0 else random.randrange(2 ** 31)
+
     IMAGES_LIST = list(IMAGE2ID_TRAIN.values())
-    random.shuffle(IMAGES_LIST)
+    random.Random(RUN_SEED).shuffle(IMAGES_LIST)
     CHUNKS = np.array_split(IMAGES_LIST, 100)
-    TEXT2VEC_ALL = tokenize_neg_space(CHUNKS, ID2CAP_TRAIN, TOKENIZER)
+    if MY_ARGS.neg_mode == "ann":
+        NEG_CHUNKS = tokenize_neg_space([IMAGES_LIST], ID2CAP_TRAIN, TOKENIZER)
+        ANN_INDEX = neg_space.AsyncIVFIndex(MY_ARGS.ann_rebuild_every, MY_ARGS.ann_lists, MY_ARGS.ann_probe)
+    else:
+        NEG_CHUNKS = tokenize_neg_space(CHUNKS, ID2CAP_TRAIN, TOKENIZER)
+        ANN_INDEX = None
+    NEG_CACHE = neg_space.NegSpaceCache(MY_ARGS.neg_refresh_every, MY_ARGS.neg_refresh_frac,
+                                        MY_ARGS.neg_max_staleness, device=device)
+
+    def img_func(inp1):
+        return teacher_net1.forward(vision_net.forward(inp1))
+
+    def prepare_batch(_batch, _img_func, _text_func, _profiler):
+        with _profiler.phase("neg_refresh"):
+            NEG_CACHE.refresh(_text_func)
+            if ANN_INDEX is not None:
+                ANN_INDEX.maybe_rebuild(NEG_CACHE.vecs)
+
+        with torch.no_grad():
+            with _profiler.phase("tokenize"):
+                _img, _cap, _mask, _id_code = process_batch(ID2CAP_TRAIN, IMAGE2ID_TRAIN, _batch, TOKENIZER)
+            with _profiler.phase("h2d"):
+                _img, _cap, _mask = tuple(t.to(device) for t in (_img, _cap, _mask))
+            with _profiler.phase("mine"):
+                _neg_rows = NEG_CACHE.mine(_img_func(_img), _id_code, 10, ANN_INDEX)
+
+            # every distinct negative of the batch is encoded once, _neg_inverse maps them back to (N, K)
+            _neg_rows, _neg_inverse = torch.unique(_neg_rows, return_inverse=True)
+            _neg_caps, _neg_masks = NEG_CACHE.tokens[_neg_rows], NEG_CACHE.masks[_neg_rows]
+            _longest = int(_neg_masks.sum(1).max().item())
+            _neg_caps, _neg_masks = _neg_caps[:, :_longest], _neg_masks[:, :_longest]
+        return _img, _cap, _mask, _id_code, _neg_caps, _neg_masks, _neg_inverse
+
+    def mine_sync(_loader):
+        for _batch in _loader:
+            teacher_net1.eval()
+            teacher_net2.eval()
+            text_net.model.eval()
+            vision_net.model.eval()
+            yield prepare_batch(_batch, img_func, text_func, PROFILER)
+
+    if MY_ARGS.neg_async == 1:
+        # the miner works with its own copy of the towers, refreshed every neg_sync_every steps
+        snap_text_net = session.text_net(device, pooling=MY_ARGS.text_pooling, nb_layers=MY_ARGS.text_layers)
+        snap_vision_net = session.vision_net(device, backbone=MY_ARGS.backbone)
+        snap_teacher_net1 = teacher_network.TeacherNet3query(snap_vision_net.out_features)
+        snap_teacher_net2 = teacher_network.TeacherNet3key()
+        snap_teacher_net1.to(device)
+        snap_teacher_net2.to(device)
+
+        def sync_snapshot():
+            snap_text_net.model.load_state_dict(text_net.model.state_dict())
+            snap_vision_net.model.load_state_dict(vision_net.model.state_dict())
+            snap_teacher_net1.load_state_dict(teacher_net1.state_dict())
+            snap_teacher_net2.load_state_dict(teacher_net2.state_dict())
+            snap_text_net.model.eval()
+            snap_vision_net.model.eval()
+            snap_teacher_net1.eval()
+            snap_teacher_net2.eval()
+
+        def snap_img_func(inp1):
+            return snap_teacher_net1.forward(snap_vision_net.forward(inp1))
+
+        def snap_text_func(inp1, inp2, sorted_lengths=False):
+            return snap_teacher_net2.forward(snap_text_net.forward(inp1, inp2, sorted_lengths=sorted_lengths))
+
+        sync_snapshot()
+        # the miner thread is not profiled, its batches are only seen as data wait of the training loop
+        miner_profiler = utils.StepProfiler()
+        NEG_MINER = neg_space.AsyncMiner(lambda _batch: prepare_batch(_batch, snap_img_func, snap_text_func,
+                                                                      miner_profiler),
+                                         MY_ARGS.neg_prefetch)
+    else:
+        NEG_MINER = None
 
     if MY_ARGS.cropping == 1:
         train_loader = torch.utils.data.DataLoader(
@@ -314,114 +339,139 @@ def main(idloss_override=None):
             batch_size=BATCH_SIZE, shuffle=True,
             num_workers=2, pin_memory=False)
 
-    for epoch in range(NB_EPOCHS):
+    train_loader, TRAIN_SAMPLER = utils.make_resumable(train_loader, RUN_SEED)
+    CKPT_MODULES = {"vision": vision_net.model, "text": text_net.model, "query_head": teacher_net1,
+                    "key_head": teacher_net2}
+    CKPT_HISTORY = {"train_losses": train_losses, "train_accs": train_accs, "train_sim": train_sim,
+                    "val_losses": val_losses, "val_accs": val_accs, "val_sim": val_sim}
+    start_epoch, start_step = 0, 0
+    if state is not None:
+        start_epoch, start_step = utils.restore_training_state(state, CKPT_MODULES, optimizer, CKPT_HISTORY,
+                                                               TRAIN_SAMPLER)
+        LOGGER.info("resumed at epoch %d, step %d" % (start_epoch, start_step))
+        if NEG_MINER is not None:
+            NEG_MINER.sync(sync_snapshot)
+        del state
+
+    for epoch in range(start_epoch, NB_EPOCHS):
         """
         Training
         """
-        running_loss = []
-        running_loss_total = []
-        running_similarity = []
-        running_enc1_var = []
-        running_enc2_var = []
-        running_corrects = 0.0
-        total_samples = 0
-        NEG_SPACE = CHUNKS[epoch % len(CHUNKS)]
-        TEXT2VEC = TEXT2VEC_ALL[epoch % len(CHUNKS)]
+        TRAIN_SAMPLER.set_epoch(epoch, start_step * BATCH_SIZE)
+        running_metrics = utils.MetricAccumulator(device)
+        NEG_CHUNK = NEG_CHUNKS[epoch % len(NEG_CHUNKS)]
         start_time = time.time()
+        PROFILER.reset()
 
-        start_time2 = time.time()
-        for step, batch in enumerate(train_loader):
-            teacher_net1.eval()
-            teacher_net2.eval()
-            text_net.model.eval()
-            vision_net.model.eval()
-
-            st1 = time.time()
-            CAP2VEC = forward_neg_space(NEG_SPACE, TEXT2VEC, ID2CAP_TRAIN, text_func, TOKENIZER, device)
-
-            with torch.no_grad():
-                img, cap, mask, id_code = process_batch(ID2CAP_TRAIN, IMAGE2ID_TRAIN, batch, TOKENIZER)
-                img, cap, mask = tuple(t.to(device) for t in (img, cap, mask))
-
-                img_vec = teacher_net1.forward(vision_net.forward(img))
-                neg_samples = []
+        teacher_net2.eval()
+        text_net.model.eval()
+        NEG_CACHE.reset_stats()
+        if NEG_CACHE.chunk is not NEG_CHUNK:
+            with PROFILER.phase("neg_load"):
+                NEG_CACHE.load(NEG_CHUNK, text_func)
+                if ANN_INDEX is not None:
+                    ANN_INDEX.rebuild(NEG_CACHE.vecs)
+        if ANN_INDEX is not None:
+            ANN_INDEX.reset_stats()
+        if NEG_MINER is not None:
+            NEG_MINER.reset_stats()
+            NEG_MINER.start(train_loader)
+            mined_batches = NEG_MINER
+        else:
+            mined_batches = mine_sync(train_loader)
 
-                for index in range(img_vec.size(0)):
-                    neg_cap, neg_mask = sample_neg_vectors(NEG_SPACE, id_code[index], img_vec[index], ID2CAP_TRAIN,
-                                                           TOKENIZER,
-                                                           TEXT2VEC, CAP2VEC,
-                                                           text_func,
-                                                           device, 10, index == img_vec.size(0)-1)
-                    neg_samples.append((neg_cap, neg_mask))
-            st2 = time.time()
+        for step, mined_batch in enumerate(PROFILER.iterate(mined_batches), start_step):
+            img, cap, mask, id_code, neg_caps, neg_masks, neg_inverse = mined_batch
 
             teacher_net1.train()
             teacher_net2.train()
             text_net.model.train()
             vision_net.model.train()
 
-            img_vec = teacher_net1.forward(vision_net.forward(img))
-            pos_txt_vec = teacher_net2.forward(text_net.forward(cap, mask))
-
-            neg_txt_vecs = [teacher_net2.forward(text_net.forward(sample[0], sample[1])) for sample in neg_samples]
-
-            loss = ranking_loss(img_vec, pos_txt_vec, neg_txt_vecs)
-            running_loss.append(loss.item())
-            if MY_ARGS.idloss:
-                loss += identification_loss(img_vec) + identification_loss(txt_vec)
-            running_loss_total.append(loss.item())
-            loss.backward()
-            st3 = time.time()
+            # the backward phase is what MicroBatcher.step spends outside the forwards and the loss
+            with utils.autocast(device, MY_ARGS.bf16 == 1), PROFILER.phase("backward"):
+                (loss_total, loss, img_vec, pos_txt_vec), _ = MICRO_BATCHER.step(
+                    [PROFILER.wrap("forward_vision", vision_net.forward),
+                     PROFILER.wrap("forward_text", text_net.forward),
+                     PROFILER.wrap("forward_neg_text", text_net.forward)],
+                    [(img,), (cap, mask), (neg_caps, neg_masks)],
+                    PROFILER.wrap("loss", lambda _i, _p, _n: heads_loss_func(_i, _p, _n, neg_inverse)))
+            running_metrics.add("loss", loss.detach())
+            running_metrics.add("loss_total", loss_total.detach())
 
             # update encoder 1 and 2
-            optimizer.step()
-            optimizer.zero_grad()
-
-            teacher_net1.eval()
-            teacher_net2.eval()
-            text_net.model.eval()
-            vision_net.model.eval()
-
-            img_vec = teacher_net1.forward(vision_net.forward(img))
-            txt_vec = teacher_net2.forward(text_net.forward(cap, mask))
-            _, preds, avg_similarity = ranking_loss2.return_logits(img_vec, txt_vec)
-            enc1_var, enc2_var = identification_loss.compute_diff(img_vec), identification_loss.compute_diff(txt_vec)
-            running_similarity.append(avg_similarity)
-            running_enc1_var.append(enc1_var)
-            running_enc2_var.append(enc2_var)
-
-            running_corrects += sum([(0 == preds[i]) for i in range(len(preds))])
-            total_samples += len(preds)
-            st4 = time.time()
-            # print("1 step took %.3f, sampling took %.3f, forwarding took %.3f, updating took %.3f" % (time.time()-st1, st2-st1, st3-st2, st4-st3))
-
-        LOGGER.info("Epoch %d: train loss = %f, max=%f min=%f" % (epoch, np.average(running_loss),
-                                                                  np.max(running_loss),
-                                                                  np.min(running_loss)))
+            with PROFILER.phase("optimizer"):
+                optimizer.step()
+                optimizer.zero_grad()
+            if CHECKPOINTER.due(step):
+                with PROFILER.phase("checkpoint"):
+                    CHECKPOINTER.save(utils.training_state(epoch, step + 1, CKPT_MODULES, optimizer, CKPT_HISTORY,
+                                                           TRAIN_SAMPLER))
+
+            with torch.no_grad(), PROFILER.phase("metrics"):
+                if utils.exact_metrics_step(MY_ARGS, step):
+                    teacher_net1.eval()
+                    teacher_net2.eval()
+                    text_net.model.eval()
+                    vision_net.model.eval()
+                    img_vec = teacher_net1.forward(vision_net.forward(img))
+                    txt_vec = teacher_net2.forward(text_net.forward(cap, mask))
+                else:
+                    txt_vec = pos_txt_vec
+                _, preds, avg_similarity = ranking_loss2.return_logits(img_vec, txt_vec, sync=False)
+                enc1_var, enc2_var = identification_loss.compute_diff(img_vec, sync=False), identification_loss.compute_diff(
+                    txt_vec, sync=False)
+            running_metrics.add("similarity", avg_similarity)
+            running_metrics.add("enc1_var", enc1_var)
+            running_metrics.add("enc2_var", enc2_var)
+
+            running_metrics.add("acc", (preds == 0).sum(), preds.size(0))
+            if NEG_MINER is not None and (step + 1) % MY_ARGS.neg_sync_every == 0:
+                with PROFILER.phase("neg_sync"):
+                    NEG_MINER.sync(sync_snapshot)
+            PROFILER.step()
+
+        train_seconds = time.time() - start_time
+        metrics = running_metrics.sync()
+        running_corrects, total_samples = metrics["acc"]["sum"], metrics["acc"]["count"]
+        LOGGER.info("Epoch %d: train loss = %f, max=%f min=%f" % (epoch, metrics["loss"]["avg"],
+                                                                  metrics["loss"]["max"],
+                                                                  metrics["loss"]["min"]))
         LOGGER.info(
             "          train acc = %f (%d/%d)" % (
                 float(running_corrects / total_samples), running_corrects, total_samples))
 
-        train_losses.append(np.average(running_loss))
+        train_losses.append(metrics["loss"]["avg"])
         train_accs.append(float(running_corrects / total_samples))
-        train_sim.append(np.average(running_similarity))
-        WRITER.add_scalar('Loss/train', np.average(running_loss), epoch)
-        WRITER.add_scalar('TotalLoss/train', np.average(running_loss_total), epoch)
+        train_sim.append(metrics["similarity"]["avg"])
+        WRITER.add_scalar('Loss/train', metrics["loss"]["avg"], epoch)
+        WRITER.add_scalar('TotalLoss/train', metrics["loss_total"]["avg"], epoch)
         WRITER.add_scalar('Accuracy/train', float(running_corrects / total_samples), epoch)
-        WRITER.add_scalar('Similarity/train', np.average(running_similarity), epoch)
-        WRITER.add_scalar('Var1/train', np.average(running_enc1_var), epoch)
-        WRITER.add_scalar('Var2/train', np.average(running_enc2_var), epoch)
+        WRITER.add_scalar('Similarity/train', metrics["similarity"]["avg"], epoch)
+        WRITER.add_scalar('Var1/train', metrics["enc1_var"]["avg"], epoch)
+        WRITER.add_scalar('Var2/train', metrics["enc2_var"]["avg"], epoch)
+
+        mean_age, max_age, nb_encoded, nb_refreshes = NEG_CACHE.age_stats()
+        LOGGER.info("          neg cache age = %.2f steps (max %d), %d captions encoded in %d refreshes"
+                    % (mean_age, max_age, nb_encoded, nb_refreshes))
+        WRITER.add_scalar('NegCacheAge/mean', mean_age, epoch)
+        WRITER.add_scalar('NegCacheAge/max', max_age, epoch)
+        WRITER.add_scalar('NegCacheEncoded/train', nb_encoded, epoch)
+        if ANN_INDEX is not None:
+            nb_builds, build_time, query_time = ANN_INDEX.stats()
+            LOGGER.info("          ann index: %d rebuilds (%.3fs each), %.4f ms per query"
+                        % (nb_builds, build_time, query_time))
+            WRITER.add_scalar('AnnQueryMs/train', query_time, epoch)
+        if NEG_MINER is not None:
+            stall_time, nb_mined = NEG_MINER.stats()
+            LOGGER.info("          waited %.3fs for the miner (%.4fs per batch)"
+                        % (stall_time, stall_time / max(1, nb_mined)))
+            WRITER.add_scalar('MinerStall/train', stall_time, epoch)
 
         """
         Validating
         """
-        running_loss = []
-        running_loss_total = []
-        running_corrects = 0.0
-        total_samples = 0
-        running_similarity = []
-        running_enc1_var = []
-        running_enc2_var = []
+        running_metrics = utils.MetricAccumulator(device)
         teacher_net1.eval()
         teacher_net2.eval()
         text_net.model.eval()
@@ -429,50 +479,68 @@ def main(idloss_override=None):
         with torch.no_grad():
             for step, batch in enumerate(valid_dataloader):
                 img, cap, mask = tuple(t.to(device) for t in batch)
-                img_vec = teacher_net1.forward(vision_net.forward(img))
-                txt_vec = teacher_net2.forward(text_net.forward(cap, mask))
+                with utils.autocast(device, MY_ARGS.bf16 == 1):
+                    img_vec = teacher_net1.forward(vision_net.forward(img))
+                    txt_vec = teacher_net2.forward(text_net.forward(cap, mask))
 
                 loss = ranking_loss2(img_vec, txt_vec)
-                running_loss.append(loss.item())
+                running_metrics.add("loss", loss.detach())
                 loss += identification_loss(img_vec) + identification_loss(txt_vec)
-                running_loss_total.append(loss.item())
-                _, preds, avg_similarity = ranking_loss2.return_logits(img_vec, txt_vec)
-                enc1_var = identification_loss.compute_diff(img_vec)
-                enc2_var = identification_loss.compute_diff(txt_vec)
-
-                running_enc1_var.append(enc1_var)
-                running_enc2_var.append(enc2_var)
-                running_similarity.append(avg_similarity)
-                running_corrects += sum([(0 == preds[i]) for i in range(len(preds))])
-                total_samples += len(preds)
-
-        LOGGER.info("          val loss = %f, max=%f min=%f" % (np.average(running_loss),
-                                                                np.max(running_loss),
-                                                                np.min(running_loss)))
+                running_metrics.add("loss_total", loss.detach())
+                _, preds, avg_similarity = ranking_loss2.return_logits(img_vec, txt_vec, sync=False)
+                enc1_var = identification_loss.compute_diff(img_vec, sync=False)
+                enc2_var = identification_loss.compute_diff(txt_vec, sync=False)
+
+                running_metrics.add("enc1_var", enc1_var)
+                running_metrics.add("enc2_var", enc2_var)
+                running_metrics.add("similarity", avg_similarity)
+                running_metrics.add("acc", (preds == 0).sum(), preds.size(0))
+
+        metrics = running_metrics.sync()
+        running_corrects, total_samples = metrics["acc"]["sum"], metrics["acc"]["count"]
+        LOGGER.info("          val loss = %f, max=%f min=%f" % (metrics["loss"]["avg"],
+                                                                metrics["loss"]["max"],
+                                                                metrics["loss"]["min"]))
         LOGGER.info(
             "          val acc = %f (%d/%d)" % (
                 float(running_corrects / total_samples), running_corrects, total_samples))
 
-        val_losses.append(np.average(running_loss))
+        val_losses.append(metrics["loss"]["avg"])
         val_accs.append(float(running_corrects / total_samples))
-        val_sim.append(np.average(running_similarity))
-        WRITER.add_scalar('Loss/val', np.average(running_loss), epoch)
-        WRITER.add_scalar('TotalLoss/val', np.average(running_loss_total), epoch)
+        val_sim.append(metrics["similarity"]["avg"])
+        WRITER.add_scalar('Loss/val', metrics["loss"]["avg"], epoch)
+        WRITER.add_scalar('TotalLoss/val', metrics["loss_total"]["avg"], epoch)
         WRITER.add_scalar('Accuracy/val', float(running_corrects / total_samples), epoch)
-        WRITER.add_scalar('Similarity/val', np.average(running_similarity), epoch)
-        WRITER.add_scalar('Var1/val', np.average(running_enc1_var), epoch)
-        WRITER.add_scalar('Var2/val', np.average(running_enc2_var), epoch)
+        WRITER.add_scalar('Similarity/val', metrics["similarity"]["avg"], epoch)
+        WRITER.add_scalar('Var1/val', metrics["enc1_var"]["avg"], epoch)
+        WRITER.add_scalar('Var2/val', metrics["enc2_var"]["avg"], epoch)
 
-        start_time3 = time.time()
-        LOGGER.error("Training took %.3f (aug: %.3f, compute: %.3f)" % (start_time3-start_time,
-                                                                        start_time2-start_time,
-                                                                        start_time3-start_time2))
+        LOGGER.error("Training took %.3f (data: %.3f, compute: %.3f, val: %.3f)" % (
+            time.time() - start_time, PROFILER.data_seconds, train_seconds - PROFILER.data_seconds,
+            time.time() - start_time - train_seconds))
+        if PROFILER.enabled:
+            PROFILER.log(LOGGER)
+            PROFILER.write_scalars(WRITER, epoch)
+            PROFILER.export_chrome_trace(logdir + "trace-epoch%d.json" % epoch)
+
+        start_step = 0
+        if MY_ARGS.ckpt_every > 0:
+            CHECKPOINTER.save(utils.training_state(epoch + 1, 0, CKPT_MODULES, optimizer, CKPT_HISTORY,
+                                                   TRAIN_SAMPLER))
+
+    CHECKPOINTER.join()
 
     if MY_ARGS.cache == 1:
-        torch.save(teacher_net1.state_dict(), "models/enc1-t1-%s" % now.strftime("%Y%m%d-%H%M%S"))
-        torch.save(teacher_net2.state_dict(), "models/enc2-t2-%s" % now.strftime("%Y%m%d-%H%M%S"))
-        torch.save(vision_net.model.state_dict(), "models/enc1-%s" % now.strftime("%Y%m%d-%H%M%S"))
-        torch.save(text_net.model.state_dict(), "models/enc2-%s" % now.strftime("%Y%m%d-%H%M%S"))
+        timeline = now.strftime("%Y%m%d-%H%M%S")
+        torch.save(teacher_net1.state_dict(), os.path.join(model_dir, "enc1-t1-%s" % timeline))
+        torch.save(teacher_net2.state_dict(), os.path.join(model_dir, "enc2-t2-%s" % timeline))
+        torch.save(vision_net.model.state_dict(), os.path.join(model_dir, "enc1-%s" % timeline))
+        torch.save(text_net.model.state_dict(), os.path.join(model_dir, "enc2-%s" % timeline))
+        bundle.save_bundle(os.path.join(model_dir, "bundle-%s.pt" % timeline), vision_net, text_net,
+                           teacher_net1, teacher_net2)
+
+    if MY_ARGS.summary:
+        utils.write_summary(MY_ARGS.summary, MY_ARGS, CKPT_HISTORY, (datetime.now() - now).total_seconds())
 
     WRITER.close()
 
@@ -496,7 +564,7 @@ def main(idloss_override=None):
     axs[2].set_xlabel('epoch')
     axs[2].set_title('sim')
 
-    fig_dir = "figures/fig_training2enc-arch%d-optim%d-nogradclip.png" % (MY_ARGS.arch,
+    fig_dir = figure_dir + "/fig_training2enc-arch%d-optim%d-nogradclip.png" % (MY_ARGS.arch,
                                                                           MY_ARGS.optim)
     fig.savefig(fig_dir)
     print("plotting figures save at %s" % fig_dir)
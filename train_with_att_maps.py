@@ -1,8 +1,9 @@
+import os
 import torch
 import utils
-import text_network
+import session_cache
+import bundle
 import teacher_network
-import vision_network
 import torch.optim as optim
 import time
 import argparse
@@ -11,7 +12,6 @@ import random
 import matplotlib.pyplot as plt
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
-from transformers import DistilBertTokenizer
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler
 from datetime import datetime
@@ -54,10 +54,8 @@ def process_batch(id2cap, img2id, _batch, _tokenizer, _prob=0.5):
     return _images, _captions, _masks
 
 
-def main(idloss_override=None, att_prob_override=None):
+def main(idloss_override=None, att_prob_override=None, session=None):
     now = datetime.now()
-    logdir = "logs/" + now.strftime("%Y%m%d-%H%M%S") + "/"
-    WRITER = SummaryWriter(logdir)
     LOGGER = utils.Logger()
     PARSER = argparse.ArgumentParser()
     PARSER.add_argument("--epochs", help="number of epochs", default=50, type=int)
@@ -71,8 +69,41 @@ def main(idloss_override=None, att_prob_override=None):
     PARSER.add_argument("--idloss", help="if training with id loss", default=0, type=int)
     PARSER.add_argument("--cropping", help="if randomly crop train images", default=1, type=int)
     PARSER.add_argument("--multi", help="if using multi gpu", default=1, type=int)
+    PARSER.add_argument("--metrics_from_train", help="if train metrics come from the training forward", default=0,
+                        type=int)
+    PARSER.add_argument("--exact_metrics_every", help="with metrics_from_train, re-forward in eval mode every n steps",
+                        default=0, type=int)
+    PARSER.add_argument("--bf16", help="if running the towers with bfloat16 autocast", default=0, type=int)
+    PARSER.add_argument("--micro_batchsize", help="split each batch into micro batches of this size (0 for none)",
+                        default=0, type=int)
+    PARSER.add_argument("--checkpoint_vision", help="activation checkpointing segments per vision stage (0 for none)",
+                        default=0, type=int)
+    PARSER.add_argument("--backbone", help="vision backbone, one of vision_network.BACKBONES", default="resnet50",
+                        type=str)
+    PARSER.add_argument("--checkpoint_text", help="activation checkpointing segments over distilbert (0 for none)",
+                        default=0, type=int)
+    PARSER.add_argument("--text_pooling", help="text tower pooling: lstm, mean or cls", default="lstm", type=str)
+    PARSER.add_argument("--text_layers", help="number of distilbert blocks of the text tower", default=6, type=int)
+    PARSER.add_argument("--ckpt_every", help="save a resumable checkpoint every n steps (0 for none)", default=0,
+                        type=int)
+    PARSER.add_argument("--ckpt_path", help="resumable checkpoint file (default: <model dir>/resume-att-maps.pt)",
+                        default="", type=str)
+    PARSER.add_argument("--resume", help="if resuming from --ckpt_path", default=0, type=int)
+    PARSER.add_argument("--seed", help="seed of the training data order, -1 for a random one (a resumed run keeps "
+                                       "the seed of its checkpoint)", default=-1, type=int)
+    PARSER.add_argument("--run_dir", help="own directory of the run for its logs, models, checkpoint and figures "
+                                          "(default: the shared logs/, models/ and figures/)", default="", type=str)
+    PARSER.add_argument("--summary", help="write the results of the run to this json file", default="", type=str)
+    PARSER.add_argument("--profile", help="time the phases of every training step, 1 for on", default=0, type=int)
+    PARSER.add_argument("--profile_steps", help="steps per epoch written to the chrome trace in the log dir",
+                        default=100, type=int)
 
     MY_ARGS = PARSER.parse_args()
+    if session is None:
+        session = session_cache.Session()
+    logdir, model_dir, figure_dir = utils.run_dirs(MY_ARGS.run_dir, now)
+    WRITER = SummaryWriter(logdir)
+    ckpt_path = MY_ARGS.ckpt_path or os.path.join(model_dir, "resume-att-maps.pt")
     att_prob = 0.5
     if idloss_override is not None:
         MY_ARGS.idloss = idloss_override
@@ -83,15 +114,10 @@ def main(idloss_override=None, att_prob_override=None):
     print(MY_ARGS)
     LOGGER.info("=============================================================")
 
-    train_img = torch.load("cached_data/train_img")
-    train_cap = torch.load("cached_data/train_cap")
-    train_mask = torch.load("cached_data/train_mask")
+    val_img = session.load_cached("val_img")
+    val_cap = session.load_cached("val_cap")
+    val_mask = session.load_cached("val_mask")
 
-    val_img = torch.load("cached_data/val_img")
-    val_cap = torch.load("cached_data/val_cap")
-    val_mask = torch.load("cached_data/val_mask")
-
-    print("Loaded train data", train_img.size(), train_cap.size(), train_mask.size())
     print("Loaded val data", val_img.size(), val_cap.size(), val_mask.size())
 
     BATCH_SIZE = MY_ARGS.batchsize
@@ -106,12 +132,14 @@ def main(idloss_override=None, att_prob_override=None):
     valid_sampler = RandomSampler(valid_data)
     valid_dataloader = DataLoader(valid_data, sampler=valid_sampler, batch_size=64, num_workers=2)
 
-    text_net = text_network.TextNet(device2)
+    text_net = session.text_net(device2, checkpoint=MY_ARGS.checkpoint_text, pooling=MY_ARGS.text_pooling,
+                                nb_layers=MY_ARGS.text_layers)
     teacher_net2 = teacher_network.TeacherNet3key()
     teacher_net2.to(device2)
 
-    vision_net = vision_network.VisionNet(device)
-    teacher_net1 = teacher_network.TeacherNet3query()
+    vision_net = session.vision_net(device, checkpoint=MY_ARGS.checkpoint_vision,
+                                    backbone=MY_ARGS.backbone)
+    teacher_net1 = teacher_network.TeacherNet3query(vision_net.out_features)
     teacher_net1.to(device)
 
     ranking_loss = teacher_network.ContrastiveLossInBatch(1, device)
@@ -151,6 +179,19 @@ def main(idloss_override=None, att_prob_override=None):
     elif MY_ARGS.optim == 2:
         optimizer = optim.Adam(teacher_net1.parameters(), lr=0.01)
 
+    MICRO_BATCHER = utils.MicroBatcher(MY_ARGS.micro_batchsize, optimizer.zero_grad,
+                                       [vision_net.model, text_net.model, teacher_net1, teacher_net2])
+    PROFILER = utils.StepProfiler(MY_ARGS.profile == 1, [device, device2], MY_ARGS.profile_steps)
+
+    def heads_loss_func(_img_feature, _txt_feature):
+        _img_vec = teacher_net1.forward(_img_feature)
+        _txt_vec = teacher_net2.forward(_txt_feature).to(device)
+        _loss = ranking_loss(_img_vec, _txt_vec)
+        _loss_total = _loss
+        if MY_ARGS.idloss:
+            _loss_total = _loss + identification_loss(_img_vec) + identification_loss(_txt_vec)
+        return _loss_total, _loss, _img_vec, _txt_vec
+
     # lr_scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=[100, 150, 200], gamma=0.1)
 
     print("Start to train")
@@ -161,8 +202,8 @@ def main(idloss_override=None, att_prob_override=None):
     val_accs = []
     val_sim = []
 
-    TOKENIZER = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
-    ID2CAP_TRAIN, IMAGE2ID_TRAIN = utils.read_caption("dataset/annotations/captions_%s2014.json" % "train")
+    TOKENIZER = session.tokenizer()
+    ID2CAP_TRAIN, IMAGE2ID_TRAIN = session.read_caption("dataset/annotations/captions_%s2014.json" % "train")
     datasets.ImageFolder.__getitem__ = utils.new_get_att_maps
 
     if MY_ARGS.cropping == 1:
@@ -184,95 +225,105 @@ def main(idloss_override=None, att_prob_override=None):
             batch_size=BATCH_SIZE, shuffle=True,
             num_workers=2, pin_memory=False)
 
-    for epoch in range(NB_EPOCHS):
+    train_loader, TRAIN_SAMPLER = utils.make_resumable(train_loader, MY_ARGS.seed if MY_ARGS.seed >= 0
+                                                       else random.randrange(2 ** 31))
+    CHECKPOINTER = utils.Checkpointer(ckpt_path, MY_ARGS.ckpt_every)
+    CKPT_MODULES = {"vision": vision_net.model, "text": text_net.model, "query_head": teacher_net1,
+                    "key_head": teacher_net2}
+    CKPT_HISTORY = {"train_losses": train_losses, "train_accs": train_accs, "train_sim": train_sim,
+                    "val_losses": val_losses, "val_accs": val_accs, "val_sim": val_sim}
+    start_epoch, start_step = 0, 0
+    if MY_ARGS.resume == 1:
+        state = CHECKPOINTER.load()
+        if state is not None:
+            start_epoch, start_step = utils.restore_training_state(state, CKPT_MODULES, optimizer, CKPT_HISTORY,
+                                                                   TRAIN_SAMPLER)
+            LOGGER.info("resumed at epoch %d, step %d" % (start_epoch, start_step))
+            del state
+
+    for epoch in range(start_epoch, NB_EPOCHS):
         """
         Training
         """
-        running_loss = []
-        running_loss_total = []
-        running_similarity = []
-        running_enc1_var = []
-        running_enc2_var = []
-        running_corrects = 0.0
-        total_samples = 0
+        TRAIN_SAMPLER.set_epoch(epoch, start_step * BATCH_SIZE)
+        running_metrics = utils.MetricAccumulator(device)
         teacher_net1.train()
         teacher_net2.train()
         text_net.model.train()
         vision_net.model.train()
         start_time = time.time()
-
-        start_time2 = time.time()
-        for step, batch in enumerate(train_loader):
+        PROFILER.reset()
+        for step, batch in enumerate(PROFILER.iterate(train_loader), start_step):
             teacher_net1.train()
             teacher_net2.train()
             text_net.model.train()
             vision_net.model.train()
 
-            img, cap, mask = process_batch(ID2CAP_TRAIN, IMAGE2ID_TRAIN, batch, TOKENIZER, att_prob)
-            img, cap, mask = img.to(device), cap.to(device2), mask.to(device2)
-
-            img_feature = vision_net.forward(img)
-            txt_feature = text_net.forward(cap, mask)
-
-            img_vec = teacher_net1.forward(img_feature)
-            txt_vec = teacher_net2.forward(txt_feature).to(device)
+            with PROFILER.phase("tokenize"):
+                img, cap, mask = process_batch(ID2CAP_TRAIN, IMAGE2ID_TRAIN, batch, TOKENIZER, att_prob)
+            with PROFILER.phase("h2d"):
+                img, cap, mask = img.to(device), cap.to(device2), mask.to(device2)
 
-            loss = ranking_loss(img_vec, txt_vec)
-            running_loss.append(loss.item())
-            if MY_ARGS.idloss:
-                loss += identification_loss(img_vec) + identification_loss(txt_vec)
-            running_loss_total.append(loss.item())
-            loss.backward()
+            # the backward phase is what MicroBatcher.step spends outside the forwards and the loss
+            with utils.autocast(device, MY_ARGS.bf16 == 1), PROFILER.phase("backward"):
+                (loss_total, loss, img_vec, txt_vec), (img_feature, txt_feature) = MICRO_BATCHER.step(
+                    [PROFILER.wrap("forward_vision", vision_net.forward),
+                     PROFILER.wrap("forward_text", text_net.forward)],
+                    [(img,), (cap, mask)], PROFILER.wrap("loss", heads_loss_func))
+            running_metrics.add("loss", loss.detach())
+            running_metrics.add("loss_total", loss_total.detach())
 
             # update encoder 1 and 2
-            optimizer.step()
-            optimizer.zero_grad()
-
-            teacher_net1.eval()
-            teacher_net2.eval()
-            text_net.model.eval()
-            vision_net.model.eval()
-
-            with torch.no_grad():
-                img_vec = teacher_net1.forward(img_feature)
-                txt_vec = teacher_net2.forward(txt_feature).to(device)
-                _, preds, avg_similarity = ranking_loss.return_logits(img_vec, txt_vec)
-                enc1_var, enc2_var = identification_loss.compute_diff(img_vec), identification_loss.compute_diff(
-                    txt_vec)
-            running_similarity.append(avg_similarity)
-            running_enc1_var.append(enc1_var)
-            running_enc2_var.append(enc2_var)
-
-            running_corrects += sum([(0 == preds[i]) for i in range(len(preds))])
-            total_samples += len(preds)
-
-        LOGGER.info("Epoch %d: train loss = %f, max=%f min=%f" % (epoch, np.average(running_loss),
-                                                                  np.max(running_loss),
-                                                                  np.min(running_loss)))
+            with PROFILER.phase("optimizer"):
+                optimizer.step()
+                optimizer.zero_grad()
+            if CHECKPOINTER.due(step):
+                with PROFILER.phase("checkpoint"):
+                    CHECKPOINTER.save(utils.training_state(epoch, step + 1, CKPT_MODULES, optimizer, CKPT_HISTORY,
+                                                           TRAIN_SAMPLER))
+
+            with torch.no_grad(), PROFILER.phase("metrics"):
+                if utils.exact_metrics_step(MY_ARGS, step):
+                    teacher_net1.eval()
+                    teacher_net2.eval()
+                    text_net.model.eval()
+                    vision_net.model.eval()
+                    img_vec = teacher_net1.forward(img_feature.float())
+                    txt_vec = teacher_net2.forward(txt_feature.float()).to(device)
+                _, preds, avg_similarity = ranking_loss.return_logits(img_vec, txt_vec, sync=False)
+                enc1_var, enc2_var = identification_loss.compute_diff(img_vec, sync=False), identification_loss.compute_diff(
+                    txt_vec, sync=False)
+            running_metrics.add("similarity", avg_similarity)
+            running_metrics.add("enc1_var", enc1_var)
+            running_metrics.add("enc2_var", enc2_var)
+
+            running_metrics.add("acc", (preds == 0).sum(), preds.size(0))
+            PROFILER.step()
+
+        train_seconds = time.time() - start_time
+        metrics = running_metrics.sync()
+        running_corrects, total_samples = metrics["acc"]["sum"], metrics["acc"]["count"]
+        LOGGER.info("Epoch %d: train loss = %f, max=%f min=%f" % (epoch, metrics["loss"]["avg"],
+                                                                  metrics["loss"]["max"],
+                                                                  metrics["loss"]["min"]))
         LOGGER.info(
             "          train acc = %f (%d/%d)" % (
                 float(running_corrects / total_samples), running_corrects, total_samples))
 
-        train_losses.append(np.average(running_loss))
+        train_losses.append(metrics["loss"]["avg"])
         train_accs.append(float(running_corrects / total_samples))
-        train_sim.append(np.average(running_similarity))
-        WRITER.add_scalar('Loss/train', np.average(running_loss), epoch)
-        WRITER.add_scalar('TotalLoss/train', np.average(running_loss_total), epoch)
+        train_sim.append(metrics["similarity"]["avg"])
+        WRITER.add_scalar('Loss/train', metrics["loss"]["avg"], epoch)
+        WRITER.add_scalar('TotalLoss/train', metrics["loss_total"]["avg"], epoch)
         WRITER.add_scalar('Accuracy/train', float(running_corrects / total_samples), epoch)
-        WRITER.add_scalar('Similarity/train', np.average(running_similarity), epoch)
-        WRITER.add_scalar('Var1/train', np.average(running_enc1_var), epoch)
-        WRITER.add_scalar('Var2/train', np.average(running_enc2_var), epoch)
+        WRITER.add_scalar('Similarity/train', metrics["similarity"]["avg"], epoch)
+        WRITER.add_scalar('Var1/train', metrics["enc1_var"]["avg"], epoch)
+        WRITER.add_scalar('Var2/train', metrics["enc2_var"]["avg"], epoch)
 
         """
         Validating
         """
-        running_loss = []
-        running_loss_total = []
-        running_corrects = 0.0
-        total_samples = 0
-        running_similarity = []
-        running_enc1_var = []
-        running_enc2_var = []
+        running_metrics = utils.MetricAccumulator(device)
         teacher_net1.eval()
         teacher_net2.eval()
         text_net.model.eval()
@@ -281,50 +332,68 @@ def main(idloss_override=None, att_prob_override=None):
             for step, batch in enumerate(valid_dataloader):
                 img, cap, mask = batch
                 img, cap, mask = img.to(device), cap.to(device2), mask.to(device2)
-                img_vec = teacher_net1.forward(vision_net.forward(img))
-                txt_vec = teacher_net2.forward(text_net.forward(cap, mask)).to(device)
+                with utils.autocast(device, MY_ARGS.bf16 == 1):
+                    img_vec = teacher_net1.forward(vision_net.forward(img))
+                    txt_vec = teacher_net2.forward(text_net.forward(cap, mask)).to(device)
 
                 loss = ranking_loss(img_vec, txt_vec)
-                running_loss.append(loss.item())
+                running_metrics.add("loss", loss.detach())
                 loss += identification_loss(img_vec) + identification_loss(txt_vec)
-                running_loss_total.append(loss.item())
-                _, preds, avg_similarity = ranking_loss.return_logits(img_vec, txt_vec)
-                enc1_var = identification_loss.compute_diff(img_vec)
-                enc2_var = identification_loss.compute_diff(txt_vec)
-
-                running_enc1_var.append(enc1_var)
-                running_enc2_var.append(enc2_var)
-                running_similarity.append(avg_similarity)
-                running_corrects += sum([(0 == preds[i]) for i in range(len(preds))])
-                total_samples += len(preds)
-
-        LOGGER.info("          val loss = %f, max=%f min=%f" % (np.average(running_loss),
-                                                                np.max(running_loss),
-                                                                np.min(running_loss)))
+                running_metrics.add("loss_total", loss.detach())
+                _, preds, avg_similarity = ranking_loss.return_logits(img_vec, txt_vec, sync=False)
+                enc1_var = identification_loss.compute_diff(img_vec, sync=False)
+                enc2_var = identification_loss.compute_diff(txt_vec, sync=False)
+
+                running_metrics.add("enc1_var", enc1_var)
+                running_metrics.add("enc2_var", enc2_var)
+                running_metrics.add("similarity", avg_similarity)
+                running_metrics.add("acc", (preds == 0).sum(), preds.size(0))
+
+        metrics = running_metrics.sync()
+        running_corrects, total_samples = metrics["acc"]["sum"], metrics["acc"]["count"]
+        LOGGER.info("          val loss = %f, max=%f min=%f" % (metrics["loss"]["avg"],
+                                                                metrics["loss"]["max"],
+                                                                metrics["loss"]["min"]))
         LOGGER.info(
             "          val acc = %f (%d/%d)" % (
                 float(running_corrects / total_samples), running_corrects, total_samples))
 
-        val_losses.append(np.average(running_loss))
+        val_losses.append(metrics["loss"]["avg"])
         val_accs.append(float(running_corrects / total_samples))
-        val_sim.append(np.average(running_similarity))
-        WRITER.add_scalar('Loss/val', np.average(running_loss), epoch)
-        WRITER.add_scalar('TotalLoss/val', np.average(running_loss_total), epoch)
+        val_sim.append(metrics["similarity"]["avg"])
+        WRITER.add_scalar('Loss/val', metrics["loss"]["avg"], epoch)
+        WRITER.add_scalar('TotalLoss/val', metrics["loss_total"]["avg"], epoch)
         WRITER.add_scalar('Accuracy/val', float(running_corrects / total_samples), epoch)
-        WRITER.add_scalar('Similarity/val', np.average(running_similarity), epoch)
-        WRITER.add_scalar('Var1/val', np.average(running_enc1_var), epoch)
-        WRITER.add_scalar('Var2/val', np.average(running_enc2_var), epoch)
+        WRITER.add_scalar('Similarity/val', metrics["similarity"]["avg"], epoch)
+        WRITER.add_scalar('Var1/val', metrics["enc1_var"]["avg"], epoch)
+        WRITER.add_scalar('Var2/val', metrics["enc2_var"]["avg"], epoch)
 
-        start_time3 = time.time()
-        LOGGER.error("Training took %.3f (aug: %.3f, compute: %.3f)" % (start_time3 - start_time,
-                                                                        start_time2 - start_time,
-                                                                        start_time3 - start_time2))
+        LOGGER.error("Training took %.3f (data: %.3f, compute: %.3f, val: %.3f)" % (
+            time.time() - start_time, PROFILER.data_seconds, train_seconds - PROFILER.data_seconds,
+            time.time() - start_time - train_seconds))
+        if PROFILER.enabled:
+            PROFILER.log(LOGGER)
+            PROFILER.write_scalars(WRITER, epoch)
+            PROFILER.export_chrome_trace(logdir + "trace-epoch%d.json" % epoch)
+
+        start_step = 0
+        if MY_ARGS.ckpt_every > 0:
+            CHECKPOINTER.save(utils.training_state(epoch + 1, 0, CKPT_MODULES, optimizer, CKPT_HISTORY,
+                                                   TRAIN_SAMPLER))
+
+    CHECKPOINTER.join()
 
     if MY_ARGS.cache == 1:
-        torch.save(teacher_net1.state_dict(), "models/enc1-t1-%s" % now.strftime("%Y%m%d-%H%M%S"))
-        torch.save(teacher_net2.state_dict(), "models/enc2-t2-%s" % now.strftime("%Y%m%d-%H%M%S"))
-        torch.save(vision_net.model.state_dict(), "models/enc1-%s" % now.strftime("%Y%m%d-%H%M%S"))
-        torch.save(text_net.model.state_dict(), "models/enc2-%s" % now.strftime("%Y%m%d-%H%M%S"))
+        timeline = now.strftime("%Y%m%d-%H%M%S")
+        torch.save(teacher_net1.state_dict(), os.path.join(model_dir, "enc1-t1-%s" % timeline))
+        torch.save(teacher_net2.state_dict(), os.path.join(model_dir, "enc2-t2-%s" % timeline))
+        torch.save(vision_net.model.state_dict(), os.path.join(model_dir, "enc1-%s" % timeline))
+        torch.save(text_net.model.state_dict(), os.path.join(model_dir, "enc2-%s" % timeline))
+        bundle.save_bundle(os.path.join(model_dir, "bundle-%s.pt" % timeline), vision_net, text_net,
+                           teacher_net1, teacher_net2)
+
+    if MY_ARGS.summary:
+        utils.write_summary(MY_ARGS.summary, MY_ARGS, CKPT_HISTORY, (datetime.now() - now).total_seconds())
 
     WRITER.close()
 
@@ -348,7 +417,7 @@ def main(idloss_override=None, att_prob_override=None):
     axs[2].set_xlabel('epoch')
     axs[2].set_title('sim')
 
-    fig_dir = "figures/fig_training2enc-arch%d-optim%d-nogradclip.png" % (MY_ARGS.arch,
+    fig_dir = figure_dir + "/fig_training2enc-arch%d-optim%d-nogradclip.png" % (MY_ARGS.arch,
                                                                           MY_ARGS.optim)
     fig.savefig(fig_dir)
     print("plotting figures save at %s" % fig_dir)
@@ -1,8 +1,7 @@
 import json
+import os
 import torch
 import numpy as np
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
 import termcolor
 import sys
 import gc
@@ -11,17 +10,27 @@ import threading
 import multiprocessing
 import pickle
 import random
-from transformers import DistilBertTokenizer
-from PIL import Image
-
-from knockknock import slack_sender
-
 
 """
-for sending notification when your code finishes
+torchvision, PIL, transformers and knockknock are imported by the functions which need them, so that
+importing utils stays cheap for the tools which only use the torch helpers
 """
-sys.stdin = open("webhook_url.txt", "r")
-SLACK_WEBHOOK = sys.stdin.readline().rstrip()
+
+
+def slack_notifier(channel="bot", webhook_file="webhook_url.txt"):
+    """
+    decorator sending a slack notification when the function finishes. Opt-in: without $SLACK_NOTIFY
+    or without the webhook file the function is returned unchanged
+    :param channel:
+    :param webhook_file: first line is the webhook url
+    :return:
+    """
+    if not os.environ.get("SLACK_NOTIFY") or not os.path.exists(webhook_file):
+        return lambda func: func
+    from knockknock import slack_sender
+    with open(webhook_file, "r") as fp:
+        webhook_url = fp.readline().rstrip()
+    return slack_sender(webhook_url=webhook_url, channel=channel)
 
 
 class Logger:
@@ -38,6 +47,582 @@ class Logger:
         print(termcolor.colored("[ERROR] %s" % information, "red", attrs=["bold"]))
 
 
+class MetricAccumulator:
+    """
+    Running sum, min, max and count of scalar metrics, kept as tensors on the device so
+    that nothing is copied to the host until sync() is called at logging time
+    """
+    def __init__(self, dev="cpu"):
+        self.dev = dev
+        self.sums = {}
+        self.mins = {}
+        self.maxs = {}
+        self.counts = {}
+
+    def add(self, name, value, count=1):
+        """
+        :param name: metric name
+        :param value: scalar tensor or number, summed up
+        :param count: how many samples value stands for, the average is sum / count
+        :return:
+        """
+        value = torch.as_tensor(value).detach().to(self.dev, torch.float64)
+        if name not in self.sums:
+            self.sums[name] = value.clone()
+            self.mins[name] = value.clone()
+            self.maxs[name] = value.clone()
+            self.counts[name] = count
+        else:
+            self.sums[name] += value
+            self.mins[name] = torch.min(self.mins[name], value)
+            self.maxs[name] = torch.max(self.maxs[name], value)
+            self.counts[name] += count
+
+    def sync(self):
+        """
+        copy everything to the host at once
+        :return: name -> dict with sum, count, avg, min and max
+        """
+        names = list(self.sums.keys())
+        if len(names) == 0:
+            return {}
+        values = torch.stack([torch.stack([self.sums[name], self.mins[name], self.maxs[name]])
+                              for name in names]).cpu().numpy()
+        res = {}
+        for idx, name in enumerate(names):
+            res[name] = {"sum": float(values[idx][0]), "count": self.counts[name],
+                         "avg": float(values[idx][0]) / self.counts[name],
+                         "min": float(values[idx][1]), "max": float(values[idx][2])}
+        return res
+
+
+class RandomState:
+    """
+    Snapshot of the cpu and cuda generators, so that a second forward sees the same dropout masks
+    """
+    def __init__(self):
+        self.cpu = torch.get_rng_state()
+        self.cuda = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+
+    def restore(self):
+        torch.set_rng_state(self.cpu)
+        if self.cuda is not None:
+            torch.cuda.set_rng_state_all(self.cuda)
+
+
+class NormStats:
+    """
+    Snapshot of the running statistics of the batch norm layers, so that a forward which is
+    repeated does not update them twice
+    """
+    def __init__(self, modules):
+        self.buffers = [(buf, buf.clone()) for module in modules for layer in module.modules()
+                        if isinstance(layer, torch.nn.modules.batchnorm._BatchNorm) and layer.track_running_stats
+                        for buf in [layer.running_mean, layer.running_var, layer.num_batches_tracked]
+                        if buf is not None]
+
+    def restore(self):
+        with torch.no_grad():
+            for buf, saved in self.buffers:
+                buf.copy_(saved)
+
+
+def rng_state():
+    """
+    :return: state of the python, numpy, torch and cuda generators
+    """
+    return {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Random order which only depends on the seed and the epoch, so that an epoch can be
+    restarted from any position with the same order
+    """
+    def __init__(self, nb_samples, seed=0):
+        self.nb_samples = nb_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """
+        :param epoch:
+        :param start: samples of the epoch already seen, skipped by the next iteration only
+        :return:
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.nb_samples, generator=generator)[self.start:].tolist()
+        self.start = 0
+        return iter(order)
+
+    def __len__(self):
+        return self.nb_samples - self.start
+
+
+def make_resumable(loader, seed=0):
+    """
+    same loader, shuffled by a ResumableSampler
+    :param loader: DataLoader
+    :param seed:
+    :return: new loader, its sampler
+    """
+    sampler = ResumableSampler(len(loader.dataset), seed)
+    return torch.utils.data.DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=sampler,
+                                       num_workers=loader.num_workers, pin_memory=loader.pin_memory), sampler
+
+
+def to_cpu(obj):
+    """
+    copy of every tensor of a (nested) state to the cpu
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def training_state(epoch, step, modules, optimizer, history, sampler):
+    """
+    :param epoch: epoch to resume
+    :param step: batches of that epoch already done
+    :param modules: name -> nn.Module
+    :param optimizer:
+    :param history: name -> list of per epoch values (losses, accuracies ...)
+    :param sampler: ResumableSampler of the training loader, its seed gives the order of every epoch
+    :return: state for Checkpointer.save
+    """
+    return {"epoch": epoch, "step": step, "rng": rng_state(), "optimizer": optimizer.state_dict(),
+            "modules": {name: module.state_dict() for name, module in modules.items()},
+            "history": {name: list(values) for name, values in history.items()}, "seed": sampler.seed}
+
+
+def restore_training_state(state, modules, optimizer, history, sampler):
+    """
+    inverse of training_state, the history lists are filled in place
+    :return: epoch, step
+    """
+    sampler.seed = state["seed"]
+    for name, module in modules.items():
+        module.load_state_dict(state["modules"][name])
+    optimizer.load_state_dict(state["optimizer"])
+    for name, values in history.items():
+        values[:] = state["history"][name]
+    set_rng_state(state["rng"])
+    return state["epoch"], state["step"]
+
+
+class Checkpointer:
+    """
+    Periodic training checkpoints. The state is copied to the cpu on the calling thread and
+    written from a background thread into a temporary file which then replaces the checkpoint,
+    so a crash while writing keeps the previous checkpoint.
+    """
+    def __init__(self, path, every=0):
+        """
+        :param path: checkpoint file
+        :param every: save every this many steps (0 for none)
+        """
+        self.path = path
+        self.every = every
+        self.thread = None
+        self.error = None
+        self.write_time = 0.0
+        self.logger = Logger()
+
+    def due(self, step):
+        return self.every > 0 and (step + 1) % self.every == 0
+
+    def save(self, state):
+        self.join()
+        snapshot = to_cpu(state)
+        self.thread = threading.Thread(target=self._write, args=(snapshot,))
+        self.thread.start()
+
+    def _write(self, snapshot):
+        start = time.time()
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            torch.save(snapshot, self.path + ".tmp")
+            os.replace(self.path + ".tmp", self.path)
+        except Exception as e:
+            self.error = e
+        self.write_time = time.time() - start
+
+    def join(self):
+        """
+        wait for the running write, raises its error if it failed
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def load(self):
+        """
+        :return: the last saved state, None if there is none
+        """
+        if not os.path.exists(self.path):
+            return None
+        self.logger.info("resuming from %s" % self.path)
+        try:
+            # our own file, it holds the numpy generator state which weights_only (default of torch >= 2.6) rejects
+            return torch.load(self.path, map_location="cpu", weights_only=False)
+        except TypeError:
+            # torch < 1.13 has no weights_only
+            return torch.load(self.path, map_location="cpu")
+
+
+def is_out_of_memory(error):
+    """
+    cuda and cpu allocation failures, torch.cuda.OutOfMemoryError is not a RuntimeError in every version
+    """
+    if isinstance(error, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    return isinstance(error, RuntimeError) and ("out of memory" in str(error) or
+                                                "can't allocate memory" in str(error))
+
+
+class MicroBatcher:
+    """
+    Forward and backward of one batch in micro batches. The encoders first run over every micro
+    batch without graph, the loss is computed on the embeddings of the whole batch (so in-batch
+    negatives stay the same) and each micro batch is then forwarded again to backpropagate its slice
+    of the embedding gradient. The loss is the one of the whole batch, except for batch norm layers
+    in train mode, which normalize with the statistics of each micro batch; their running statistics
+    are restored after the first pass, so they are updated once per micro batch by the second one.
+    When a step runs out of memory the micro batch is halved and the step is retried, the halved
+    size is kept for the next steps.
+    """
+    def __init__(self, micro_batch=0, zero_grad=None, modules=()):
+        """
+        :param micro_batch: samples per micro batch (0 for the whole batch)
+        :param zero_grad: called to drop the gradients of a failed attempt, e.g. optimizer.zero_grad
+        :param modules: modules run by the encoders, their batch norm statistics are kept out of the first pass
+        """
+        self.micro_batch = micro_batch
+        self.zero_grad = zero_grad
+        self.modules = list(modules)
+        self.nb_retries = 0
+        self.logger = Logger()
+
+    def split(self, inputs):
+        return zip(*[inp.split(self.micro_batch) for inp in inputs])
+
+    def step(self, encoders, inputs, loss_func):
+        """
+        gradients are accumulated into the parameters, the optimizer step is left to the caller
+        :param encoders: list of functions, encoder i is called with the tensors of inputs[i]
+        :param inputs: list of tuples of tensors, the tensors of a tuple share their first dimension
+        :param loss_func: embeddings of every encoder -> loss, or a tuple whose first item is the loss
+        :return: detached outputs of loss_func and embeddings
+        """
+        norm_stats = NormStats(self.modules)
+        while True:
+            try:
+                return self._step(encoders, inputs, loss_func, norm_stats)
+            except Exception as e:
+                if not is_out_of_memory(e):
+                    raise
+            norm_stats.restore()
+            # out of the except block so that the failed graph can be freed
+            batch_size = max([inp[0].size(0) for inp in inputs])
+            current = self.micro_batch if 0 < self.micro_batch < batch_size else batch_size
+            if current <= 1:
+                raise RuntimeError("out of memory with a micro batch of 1")
+            self.micro_batch = current // 2
+            self.nb_retries += 1
+            self.logger.error("out of memory, retrying with micro batches of %d" % self.micro_batch)
+            if self.zero_grad is not None:
+                self.zero_grad()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _step(self, encoders, inputs, loss_func, norm_stats):
+        if self.micro_batch <= 0 or all([inp[0].size(0) <= self.micro_batch for inp in inputs]):
+            reps = [enc(*inp) for enc, inp in zip(encoders, inputs)]
+            outputs = loss_func(*reps)
+            loss = outputs[0] if isinstance(outputs, tuple) else outputs
+            loss.backward()
+            return self.detach(outputs), [rep.detach() for rep in reps]
+
+        reps = []
+        states = []
+        with torch.no_grad():
+            for enc, inp in zip(encoders, inputs):
+                states.append([])
+                enc_reps = []
+                for chunk in self.split(inp):
+                    states[-1].append(RandomState())
+                    enc_reps.append(enc(*chunk))
+                reps.append(torch.cat(enc_reps).detach().requires_grad_())
+        norm_stats.restore()
+
+        outputs = loss_func(*reps)
+        loss = outputs[0] if isinstance(outputs, tuple) else outputs
+        loss.backward()
+
+        current_state = RandomState()
+        for enc, inp, rep, enc_states in zip(encoders, inputs, reps, states):
+            for chunk, grad, state in zip(self.split(inp), rep.grad.split(self.micro_batch), enc_states):
+                state.restore()
+                enc(*chunk).backward(grad)
+        current_state.restore()
+        return self.detach(outputs), [rep.detach() for rep in reps]
+
+    @staticmethod
+    def detach(outputs):
+        if isinstance(outputs, tuple):
+            return tuple([du.detach() for du in outputs])
+        return outputs.detach()
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.begin(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler.end()
+
+
+class _NoPhase:
+    def __enter__(self):
+        return
+
+    def __exit__(self, *exc):
+        return
+
+
+class StepProfiler:
+    """
+    Wall time of the phases of every training step (data wait, tokenization, host to device copy,
+    forward of each tower, loss, backward, optimizer, metrics). Phases can be nested, the time of
+    a phase excludes the phases run inside it, so the backward of MicroBatcher.step is what is left
+    once the forwards and the loss are taken out. A function given to wrap() is timed as
+    "<name>_nograd" when it runs without autograd, so the first pass of MicroBatcher.step over the
+    micro batches is told apart from the forward whose graph is backpropagated. When disabled,
+    phase() returns a shared no-op context and only the data wait of the epoch is measured.
+    """
+    def __init__(self, enabled=False, devices=("cpu",), trace_steps=100):
+        """
+        :param enabled:
+        :param devices: every device the timed phases run on (e.g. the devices of both towers), the
+        cuda ones are synchronized at the phase boundaries, so that the kernels are timed in the
+        phase which launched them
+        :param trace_steps: steps per epoch kept as events for the chrome trace
+        """
+        self.enabled = enabled
+        self.sync_devices = []
+        if enabled and torch.cuda.is_available():
+            self.sync_devices = sorted(set([torch.device(dev) for dev in devices]), key=str)
+            self.sync_devices = [dev for dev in self.sync_devices if dev.type == "cuda"]
+        self.trace_steps = trace_steps
+        self.no_phase = _NoPhase()
+        self.reset()
+
+    def reset(self):
+        """
+        start of an epoch
+        """
+        self.totals = {}
+        self.stack = []
+        self.events = []
+        self.nb_steps = 0
+        self.data_seconds = 0.0
+        self.origin = time.time()
+
+    def synchronize(self):
+        for dev in self.sync_devices:
+            torch.cuda.synchronize(dev)
+
+    def begin(self, name):
+        self.synchronize()
+        self.stack.append([name, time.time(), 0.0])
+
+    def end(self):
+        self.synchronize()
+        name, start, children = self.stack.pop()
+        duration = time.time() - start
+        self.totals[name] = self.totals.get(name, 0.0) + duration - children
+        if self.stack:
+            self.stack[-1][2] += duration
+        if self.nb_steps < self.trace_steps:
+            self.events.append({"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": (start - self.origin) * 1e6,
+                                "dur": duration * 1e6, "args": {"step": self.nb_steps}})
+
+    def phase(self, name):
+        """
+        :param name:
+        :return: context manager timing its block as the phase name
+        """
+        if not self.enabled:
+            return self.no_phase
+        return _Phase(self, name)
+
+    def wrap(self, name, func):
+        """
+        :return: func timed as the phase name (name_nograd without autograd), func itself when disabled
+        """
+        if not self.enabled:
+            return func
+
+        def timed(*args, **kwargs):
+            with self.phase(name if torch.is_grad_enabled() else name + "_nograd"):
+                return func(*args, **kwargs)
+        return timed
+
+    def iterate(self, loader):
+        """
+        the batches of loader, the time spent waiting for each of them is the "data" phase
+        """
+        iterator = iter(loader)
+        while True:
+            start = time.time()
+            with self.phase("data"):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            self.data_seconds += time.time() - start
+            yield batch
+
+    def step(self):
+        """
+        end of a training step
+        """
+        self.nb_steps += 1
+
+    def summary(self):
+        """
+        :return: phase -> ms per step
+        """
+        return {name: total * 1000 / max(1, self.nb_steps) for name, total in self.totals.items()}
+
+    def write_scalars(self, writer, epoch):
+        for name, ms in self.summary().items():
+            writer.add_scalar("StepTime/%s" % name, ms, epoch)
+
+    def export_chrome_trace(self, path):
+        """
+        json of the traced steps, opened by chrome://tracing or https://ui.perfetto.dev
+        """
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fp)
+
+    def log(self, logger):
+        summary = self.summary()
+        total = sum(summary.values())
+        logger.info("          step time %.1f ms: %s" % (total, ", ".join(
+            ["%s %.1f" % (name, ms) for name, ms in sorted(summary.items(), key=lambda du: -du[1])])))
+
+
+def load_cached(name, cache_dir="cached_data"):
+    """
+    a cached tensor, memory mapped so that only the rows which are read get paged in. The torch.save'd
+    file is converted once into a .npy next to it, or taken from $CACHED_DATA_DIR when the sweep runner
+    put it in shared memory
+    :param name: e.g. "val_img"
+    :param cache_dir: where the torch.save'd tensors are
+    :return:
+    """
+    shared_dir = os.environ.get("CACHED_DATA_DIR")
+    if shared_dir is not None and os.path.exists(os.path.join(shared_dir, name + ".npy")):
+        path = os.path.join(shared_dir, name + ".npy")
+    else:
+        path = os.path.join(cache_dir, name + ".npy")
+        source = os.path.join(cache_dir, name)
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+            # own temporary file per process, concurrent runs (sweep.py) may convert the same tensor
+            tmp_path = "%s.%d.tmp.npy" % (path, os.getpid())
+            np.save(tmp_path, torch.load(source).numpy())
+            os.replace(tmp_path, path)
+    # copy on write, the pages are shared between the processes as long as they are only read
+    return torch.from_numpy(np.load(path, mmap_mode="c"))
+
+
+class CachedTensor:
+    """
+    Handle of a cached tensor which is only opened (memory mapped) when it is used
+    """
+    def __init__(self, name, cache_dir="cached_data"):
+        self.name = name
+        self.cache_dir = cache_dir
+        self._tensor = None
+
+    def tensor(self):
+        if self._tensor is None:
+            self._tensor = load_cached(self.name, self.cache_dir)
+        return self._tensor
+
+    def size(self, *dim):
+        return self.tensor().size(*dim)
+
+    def __len__(self):
+        return self.size(0)
+
+    def __getitem__(self, index):
+        return self.tensor()[index]
+
+
+def run_dirs(run_dir, now):
+    """
+    :param run_dir: directory of the run, "" for the shared logs/, models/ and figures/ directories
+    :param now: start of the run, names the log dir
+    :return: log dir (with a trailing /), model dir, figure dir
+    """
+    if not run_dir:
+        return "logs/" + now.strftime("%Y%m%d-%H%M%S") + "/", "models", "figures"
+    for sub_dir in ["logs", "models", "figures"]:
+        if not os.path.exists(os.path.join(run_dir, sub_dir)):
+            os.makedirs(os.path.join(run_dir, sub_dir))
+    return os.path.join(run_dir, "logs") + "/", os.path.join(run_dir, "models"), os.path.join(run_dir, "figures")
+
+
+def write_summary(path, args, history, seconds):
+    """
+    results of a run as json, collected by sweep.py
+    :param path:
+    :param args: parsed arguments of the run
+    :param history: name -> list of per epoch values, with train_losses, train_accs, val_losses, val_accs
+    :param seconds: wall clock time of the run
+    :return:
+    """
+    summary = {"args": vars(args), "seconds": seconds, "epochs": len(history["val_accs"]),
+               "final_train_loss": history["train_losses"][-1] if history["train_losses"] else None,
+               "final_train_acc": history["train_accs"][-1] if history["train_accs"] else None,
+               "final_val_loss": history["val_losses"][-1] if history["val_losses"] else None,
+               "final_val_acc": history["val_accs"][-1] if history["val_accs"] else None,
+               "best_val_acc": max(history["val_accs"]) if history["val_accs"] else None,
+               "history": {name: [float(du) for du in values] for name, values in history.items()}}
+    with open(path, "w") as fp:
+        json.dump(summary, fp, indent=2)
+
+
 def read_caption(filename="dataset/annotations/captions_val2014.json"):
     with open('cached_data/%s_images_salicon' % "train", 'rb') as fp:
         image_list = pickle.load(fp)
@@ -90,6 +675,8 @@ def new_get_att_maps(self, index):
     :param index:
     :return:
     """
+    import torchvision.transforms as transforms
+    from PIL import Image
     seed = np.random.randint(2147483647)  # make a seed with numpy generator
     norm_transform = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 
@@ -113,6 +700,9 @@ def new_get_att_maps(self, index):
 
 
 def cache_data_helper1(which, limit):
+    import torchvision.transforms as transforms
+    import torchvision.datasets as datasets
+    from transformers import DistilBertTokenizer
     # Load image list from SALICON
     with open('cached_data/%s_images_salicon' % which, 'rb') as fp:
         image_list = pickle.load(fp)
@@ -240,7 +830,55 @@ def calculate_nb_params(models):
     return res
 
 
+def autocast(dev, enabled=True):
+    """
+    bfloat16 autocast for the device type of dev, the teacher heads and the losses
+    switch back to float32 for the normalization and the logits
+    :param dev: e.g. "cpu" or "cuda:0"
+    :param enabled:
+    :return: context manager
+    """
+    return torch.autocast(device_type=torch.device(dev).type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def retrieval_accuracy(img_vecs, txt_vecs, top_n=64, chunk_size=1024):
+    """
+    image to text retrieval where the i-th caption belongs to the i-th image
+    :param img_vecs: (n, C)
+    :param txt_vecs: (n, C)
+    :param top_n: the caption has to rank within the first top_n
+    :param chunk_size: images scored at once
+    :return: number of images, correct at top 1, correct at top n
+    """
+    nb_images = img_vecs.size(0)
+    correct = 0
+    correctn = 0
+    for start in range(0, nb_images, chunk_size):
+        scores = torch.mm(img_vecs[start: start + chunk_size].float(), txt_vecs.float().t())
+        rows = torch.arange(scores.size(0), device=scores.device)
+        pos_scores = scores[rows, rows + start]
+        ranks = torch.sum(scores > pos_scores.view(-1, 1), dim=1)
+        correct += torch.sum(ranks == 0).item()
+        correctn += torch.sum(ranks < top_n).item()
+    return nb_images, correct, correctn
+
+
+def exact_metrics_step(args, step):
+    """
+    if the train metrics of this step need their own forward in eval mode, otherwise
+    they are taken from the embeddings of the training forward
+    :param args: parsed arguments with metrics_from_train and exact_metrics_every
+    :param step:
+    :return:
+    """
+    if args.metrics_from_train == 0:
+        return True
+    return args.exact_metrics_every > 0 and step % args.exact_metrics_every == 0
+
+
 def load_maps(which):
+    import torchvision.transforms as transforms
+    from PIL import Image
     from os import listdir
     from os.path import isfile, join
     mypath = "dataset/maps/%s" % which
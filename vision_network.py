@@ -1,7 +1,5 @@
-import torchvision.models
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
 import torch
+import torch.utils.checkpoint
 import types
 
 
@@ -17,10 +15,13 @@ def forward_layer(self, y):
     y = self.relu(y)
     y = self.maxpool(y)
 
-    y = self.layer1(y)
-    y = self.layer2(y)
-    y = self.layer3(y)
-    y = self.layer4(y)
+    for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+        if self.checkpoint > 0 and self.training and torch.is_grad_enabled():
+            # only the inputs of each segment are kept, the blocks are recomputed in backward
+            y = torch.utils.checkpoint.checkpoint_sequential(layer, min(self.checkpoint, len(layer)), y,
+                                                             use_reentrant=False)
+        else:
+            y = layer(y)
 
     y = self.avgpool(y)
     y = torch.flatten(y, 1)
@@ -28,10 +29,56 @@ def forward_layer(self, y):
     return y
 
 
+def forward_features(self, y):
+    """
+    forward of the backbones with a features module (mobilenet, efficientnet), without classifier
+    :param self:
+    :param y:
+    :return:
+    """
+    if self.checkpoint > 0 and self.training and torch.is_grad_enabled():
+        y = torch.utils.checkpoint.checkpoint_sequential(self.features, min(self.checkpoint, len(self.features)), y,
+                                                         use_reentrant=False)
+    else:
+        y = self.features(y)
+
+    y = torch.nn.functional.adaptive_avg_pool2d(y, 1)
+    y = torch.flatten(y, 1)
+
+    return y
+
+
+# name -> (torchvision constructor, forward, width of the returned feature)
+BACKBONES = {
+    "resnet18": ("resnet18", forward_layer, 512),
+    "resnet34": ("resnet34", forward_layer, 512),
+    "resnet50": ("resnet50", forward_layer, 2048),
+    "mobilenet_v2": ("mobilenet_v2", forward_features, 1280),
+    "mobilenet_v3_small": ("mobilenet_v3_small", forward_features, 576),
+    "mobilenet_v3_large": ("mobilenet_v3_large", forward_features, 960),
+    "efficientnet_b0": ("efficientnet_b0", forward_features, 1280),
+}
+
+
 class VisionNet:
-    def __init__(self, dev="cpu"):
-        self.model = torchvision.models.resnet50(pretrained=True)
-        self.model.forward_layer = types.MethodType(forward_layer, self.model)
+    def __init__(self, dev="cpu", checkpoint=0, backbone="resnet50", pretrained=True):
+        """
+        :param dev:
+        :param checkpoint: activation checkpointing segments per stage (layer1..layer4 for resnets, the
+        features module otherwise), 0 for none, 1 keeps only the input of each stage, 6 checkpoints
+        every bottleneck block of resnet50
+        :param backbone: one of BACKBONES
+        :param pretrained: if loading the imagenet weights, False when the weights come from a checkpoint
+        """
+        assert backbone in BACKBONES, "unknown backbone %s" % backbone
+        # torchvision is imported here so that importing the module stays cheap
+        import torchvision.models
+        self.backbone = backbone
+        constructor, forward, self.out_features = BACKBONES[backbone]
+        assert hasattr(torchvision.models, constructor), "this torchvision has no %s" % constructor
+        self.model = getattr(torchvision.models, constructor)(pretrained=pretrained)
+        self.model.forward_layer = types.MethodType(forward, self.model)
+        self.model.checkpoint = checkpoint
         self.model.to(dev)
 
     def forward(self, image):
@@ -46,6 +93,8 @@ class VisionNet:
 
 
 if __name__ == "__main__":
+    import torchvision.transforms as transforms
+    import torchvision.datasets as datasets
     net = VisionNet()
 
     traindir = "dataset/val"